@@ -1 +1,45 @@
 name = "lailib"
+
+# the public api is importable from the package, e.g. lailib.load_json, but a module
+# (and its cv2 / numpy / torch dependencies) is only imported on first attribute access
+_LAZY_ATTRIBUTES = {
+    'lailib.io': ('load_json', 'clear_json_cache', 'iter_jsonl', 'iter_json_array', 'JSON_BACKEND'),
+    'lailib.image.binarize': ('otsu_thresh', 'vanilla_thresh', 'intensity_histograms', 'otsu_thresh_batch',
+                              'tiled_thresh'),
+    'lailib.image.crop': ('crop_boundary_and_padding', 'crop_boundary_and_padding_batch', 'crop_boxes_batch',
+                          'region_boxes', 'crop_regions_and_padding', 'crop_boundary_and_padding_chunked'),
+    'lailib.image.resize_im': ('resize_height_keep_ratio', 'resized_widths', 'resize_height_keep_ratio_batch',
+                               'WidthBucketSampler'),
+    'lailib.image.pipeline': ('PreprocessPipeline', 'PipelineResult'),
+    'lailib.image.cache': ('PreprocessCache',),
+    'lailib.image.packed_dataset': ('PackedImageWriter', 'PackedImageDataset'),
+    'lailib.torch.parameter_store': ('save_network', 'load_network', 'load_last_checkpoint', 'checkpoint_steps',
+                                     'checkpoint_options', 'average_checkpoints', 'AsyncCheckpointSaver',
+                                     'CHECKPOINT_FORMATS'),
+    'lailib.torch.checkpoint_manager': ('CheckpointManager',),
+    'lailib.torch.tensor_file': ('TensorFile', 'save_tensors', 'save_state', 'load_state'),
+    'lailib.torch.delta_checkpoint': ('DeltaCheckpointer', 'load_delta_state'),
+    'lailib.torch.sharded_checkpoint': ('save_sharded', 'load_sharded_state'),
+}
+_ATTRIBUTE_MODULES = dict((attribute, module) for module, attributes in _LAZY_ATTRIBUTES.items()
+                          for attribute in attributes)
+_SUBMODULES = ('io', 'profiling', 'benchmark', 'image', 'torch')
+
+__all__ = sorted(_ATTRIBUTE_MODULES)
+
+
+def __getattr__(attribute):
+    import importlib
+    if attribute in _SUBMODULES:
+        return importlib.import_module('lailib.' + attribute)
+    module = _ATTRIBUTE_MODULES.get(attribute)
+    if module is None:
+        raise AttributeError("module 'lailib' has no attribute '{}'".format(attribute))
+    value = getattr(importlib.import_module(module), attribute)
+    # later lookups find the value directly and skip __getattr__
+    globals()[attribute] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | set(_SUBMODULES))
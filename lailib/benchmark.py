@@ -0,0 +1,385 @@
+'''
+cpu benchmark suite for the lailib hot paths on synthetic inputs
+
+usage:
+    python -m lailib.benchmark --quick
+    python -m lailib.benchmark --save-baseline benchmarks/baseline.json
+    python -m lailib.benchmark --baseline benchmarks/baseline.json --threshold 0.25
+
+every case reports latency percentiles, throughput and the peak resident memory of one call,
+--baseline compares the p50 latency (or --metric) against a stored run and the command
+exits with status 1 if a case regressed by more than the threshold.
+'''
+import argparse
+import contextlib
+import ctypes
+import functools
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# name -> (height, width) of the synthetic gray scale images
+IMAGE_SIZES = {'line': (48, 640), 'paragraph': (512, 2048), 'page': (3300, 2550)}
+# name -> number of records of the synthetic json files
+JSON_SIZES = {'small': 100, 'large': 100000}
+# name -> approximate number of float32 parameters of the synthetic models
+MODEL_SIZES = {'tiny': 10 ** 4, 'big': 10 ** 7}
+QUICK_SIZES = ('line', 'small', 'tiny')
+RESIZE_HEIGHT = 32
+# statistics compare can check, throughput regresses when it shrinks, the others when they grow
+LOWER_IS_BETTER = ('mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'min_ms', 'peak_mb')
+HIGHER_IS_BETTER = ('items_per_s', 'mb_per_s')
+# name -> code run in a fresh interpreter, spawn-to-ready time of a worker using that part of lailib
+IMPORT_TARGETS = {'python': 'pass',
+                  'lailib': 'import lailib',
+                  'load_json': 'import lailib; lailib.load_json',
+                  'crop_boundary_and_padding': 'import lailib; lailib.crop_boundary_and_padding',
+                  'save_network': 'import lailib; lailib.save_network'}
+
+
+def synthetic_page(height, width, seed=0):
+    '''
+    white page with dark text like strokes inside a margin, noise included so otsu
+    has a real histogram to work on
+    :return: (height, width) uint8 image
+    '''
+    rng = np.random.RandomState(seed)
+    im = rng.randint(225, 256, size=(height, width)).astype(np.uint8)
+    top, left = height // 8, width // 10
+    region = im[top:height - top, left:width - left]
+    strokes = rng.rand(*region.shape) < 0.2
+    region[strokes] = rng.randint(0, 60, size=int(strokes.sum()))
+    return im
+
+
+def _json_records(n, seed=0):
+    rng = np.random.RandomState(seed)
+    return [{'id': i, 'text': 'line %d' % i, 'box': rng.randint(0, 1000, size=4).tolist(),
+             'score': float(rng.rand())} for i in range(n)]
+
+
+def _reset_peak_rss():
+    '''
+    hand freed heap pages back to the os and restart the peak resident set size (VmHWM) from the
+    current size, so memory reused from the allocators counts as growth
+    :return: True if the peak was reset (linux)
+    '''
+    try:
+        ctypes.CDLL(None).malloc_trim(0)
+    except (OSError, AttributeError):
+        # not glibc
+        pass
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def _proc_status_bytes(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+    raise KeyError(field)
+
+
+def _maxrss_bytes():
+    # ru_maxrss is in kilobytes on linux and in bytes on macos
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def _peak_rss_growth(fn):
+    if _reset_peak_rss():
+        start = _proc_status_bytes('VmRSS')
+        fn()
+        return _proc_status_bytes('VmHWM') - start
+    # the high water mark of a forked child starts around its size at fork
+    start = _maxrss_bytes()
+    fn()
+    return _maxrss_bytes() - start
+
+
+def peak_memory(fn):
+    '''
+    peak memory of one call of fn. Where fork is available the call runs in a forked child and the
+    growth of its resident set is reported, so the torch allocator and cv2 buffers are counted,
+    processes spawned by fn are not. Elsewhere tracemalloc is used, it only sees python and numpy
+    allocations.
+    :param fn: callable without arguments
+    :return: peak memory in bytes
+    '''
+    if not hasattr(os, 'fork') or resource is None:
+        tracemalloc.start()
+        try:
+            fn()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    read_fd, write_fd = os.pipe()
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read_fd)
+            os.write(write_fd, str(_peak_rss_growth(fn)).encode())
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as f:
+        output = f.read()
+    _, status = os.waitpid(pid, 0)
+    if status != 0 or not output:
+        raise RuntimeError('peak memory measurement failed with status {}'.format(status))
+    return max(int(output), 0)
+
+
+def measure(fn, repeat=20, warmup=2, items=1, nbytes=0):
+    '''
+    time fn and record the peak memory of one extra call, see peak_memory
+    :param fn: callable without arguments
+    :param repeat: timed calls
+    :param warmup: untimed calls before timing
+    :param items: items processed per call, for items_per_s
+    :param nbytes: input bytes processed per call, for mb_per_s
+    :return: dict of statistics, latencies in milliseconds
+    '''
+    for _ in range(warmup):
+        fn()
+    gc.collect()
+    latencies = np.empty(repeat, dtype=np.float64)
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies[i] = time.perf_counter() - start
+    peak = peak_memory(fn)
+    mean = float(latencies.mean())
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1e3
+    return {'repeat': repeat,
+            'mean_ms': mean * 1e3,
+            'p50_ms': float(p50),
+            'p90_ms': float(p90),
+            'p99_ms': float(p99),
+            'min_ms': float(latencies.min() * 1e3),
+            'items_per_s': items / mean if mean > 0 else float('inf'),
+            'mb_per_s': nbytes / mean / 2 ** 20 if mean > 0 else float('inf'),
+            'peak_mb': peak / 2 ** 20}
+
+
+def _import_cases():
+    for target, code in IMPORT_TARGETS.items():
+        yield 'import/%s' % target, \
+            functools.partial(subprocess.run, [sys.executable, '-c', code], check=True), 0, None
+
+
+def _image_cases(sizes):
+    from lailib.image.binarize import otsu_thresh
+    from lailib.image.crop import crop_boundary_and_padding
+    from lailib.image.resize_im import resize_height_keep_ratio
+
+    for size in sizes:
+        if size not in IMAGE_SIZES:
+            continue
+        im = synthetic_page(*IMAGE_SIZES[size])
+        binarized = otsu_thresh(im)
+        yield 'otsu_thresh/%s' % size, lambda im=im: otsu_thresh(im), im.nbytes, None
+        yield 'crop_boundary_and_padding/%s' % size, \
+            lambda im=im, b=binarized: crop_boundary_and_padding(im, 8, b), im.nbytes, None
+        yield 'resize_height_keep_ratio/%s' % size, \
+            lambda im=im: resize_height_keep_ratio(im, RESIZE_HEIGHT), im.nbytes, None
+
+
+def _json_cases(sizes, tmp_dir):
+    from lailib.io import load_json
+
+    for size in sizes:
+        if size not in JSON_SIZES:
+            continue
+        path = os.path.join(tmp_dir, 'bench_%s.json' % size)
+        with open(path, 'w') as f:
+            json.dump({'records': _json_records(JSON_SIZES[size])}, f)
+        yield 'load_json/%s' % size, lambda path=path: load_json(path), os.path.getsize(path), None
+
+
+def _checkpoint_cases(sizes, tmp_dir):
+    import torch
+    from lailib.torch.parameter_store import save_network, load_network
+
+    for size in sizes:
+        if size not in MODEL_SIZES:
+            continue
+        width = int(np.sqrt(MODEL_SIZES[size] / 4))
+        network = torch.nn.Sequential(*[torch.nn.Linear(width, width) for _ in range(4)])
+        optimizer = torch.optim.SGD(network.parameters(), lr=0.1)
+        nbytes = sum(p.numel() * p.element_size() for p in network.state_dict().values())
+        save_dir = os.path.join(tmp_dir, 'checkpoints_%s' % size)
+        os.makedirs(save_dir)
+        for fmt in ('pth', 'tensors'):
+            save = functools.partial(save_network, network, optimizer, save_dir, 'bench', 0, use_gpu=False, fmt=fmt)
+            load = functools.partial(load_network, network, optimizer, save_dir, 'bench', 0, use_gpu=False, fmt=fmt)
+            yield 'save_network/%s/%s' % (fmt, size), save, nbytes, None
+            yield 'load_network/%s/%s' % (fmt, size), load, nbytes, save
+
+
+def run_benchmarks(names=None, sizes=None, repeat=20, warmup=2, verbose=False):
+    '''
+    run the benchmark cases on cpu
+    :param names: optional list of substrings, only cases whose name contains one of them run
+    :param sizes: optional list of size names (see IMAGE_SIZES, JSON_SIZES, MODEL_SIZES), default all
+    :param repeat: timed calls per case
+    :param warmup: untimed calls per case
+    :param verbose: print every case when it is done
+    :return: dict with 'environment' and 'results' (case name -> statistics of measure)
+    '''
+    if sizes is None:
+        sizes = list(IMAGE_SIZES) + list(JSON_SIZES) + list(MODEL_SIZES)
+    groups = [('otsu_thresh', 'crop_boundary_and_padding', 'resize_height_keep_ratio'),
+              ('load_json',), ('save_network', 'load_network'), ('import/',)]
+    wanted = [names is None or any(name in prefix or prefix in name for prefix in group for name in names)
+              for group in groups]
+    tmp_dir = tempfile.mkdtemp(prefix='lailib_bench_')
+    results = {}
+    try:
+        generators = []
+        if wanted[0]:
+            generators.append(_image_cases(sizes))
+        if wanted[1]:
+            generators.append(_json_cases(sizes, tmp_dir))
+        if wanted[2]:
+            generators.append(_checkpoint_cases(sizes, tmp_dir))
+        if wanted[3]:
+            generators.append(_import_cases())
+        for generator in generators:
+            for case, fn, nbytes, setup in generator:
+                if names is not None and not any(name in case for name in names):
+                    continue
+                # load_network reports every load on stdout
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    if setup is not None:
+                        setup()
+                    results[case] = measure(fn, repeat=repeat, warmup=warmup, nbytes=nbytes)
+                if verbose:
+                    print(format_result(case, results[case]))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return {'environment': environment(), 'results': results}
+
+
+def environment():
+    '''
+    :return: dict describing the machine and library versions of a run
+    '''
+    import cv2
+    env = {'python': platform.python_version(),
+           'machine': platform.machine(),
+           'processor': platform.processor(),
+           'cpu_count': os.cpu_count(),
+           'numpy': np.__version__,
+           'cv2': cv2.__version__}
+    try:
+        import torch
+        env['torch'] = torch.__version__
+    except ImportError:
+        pass
+    return env
+
+
+def format_result(case, stats):
+    return '%-45s p50 %9.3f ms  p90 %9.3f ms  p99 %9.3f ms  %10.1f MB/s  peak %8.2f MB' % (
+        case, stats['p50_ms'], stats['p90_ms'], stats['p99_ms'], stats['mb_per_s'], stats['peak_mb'])
+
+
+def compare(results, baseline, threshold=0.2, metric='p50_ms', thresholds=None):
+    '''
+    compare a run against a baseline run, cases missing on either side are ignored
+    :param results: output of run_benchmarks
+    :param baseline: output of run_benchmarks, e.g. loaded from a baseline file
+    :param threshold: allowed relative slowdown, 0.2 flags cases more than 20% slower
+    :param metric: statistic to compare, one of LOWER_IS_BETTER or HIGHER_IS_BETTER
+    :param thresholds: optional dict of case name -> threshold overriding the default
+    :return: list of dicts with case, baseline, current and ratio of the regressed cases,
+             ratio is the slowdown factor (current / baseline, or baseline / current for throughput)
+    '''
+    if metric not in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+        raise ValueError('metric must be one of {}'.format(LOWER_IS_BETTER + HIGHER_IS_BETTER))
+    thresholds = thresholds or {}
+    regressions = []
+    current_results = results.get('results', results)
+    baseline_results = baseline.get('results', baseline)
+    for case in sorted(set(current_results) & set(baseline_results)):
+        reference = baseline_results[case][metric]
+        current = current_results[case][metric]
+        if reference <= 0:
+            continue
+        if metric in HIGHER_IS_BETTER:
+            ratio = reference / current if current > 0 else float('inf')
+        else:
+            ratio = current / reference
+        if ratio > 1 + thresholds.get(case, threshold):
+            regressions.append({'case': case, 'baseline': reference, 'current': current, 'ratio': ratio})
+    return regressions
+
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='lailib cpu benchmarks')
+    parser.add_argument('--filter', nargs='*', default=None, help='substrings of the cases to run')
+    parser.add_argument('--sizes', nargs='*', default=None, help='size names to run, default all')
+    parser.add_argument('--quick', action='store_true', help='only the smallest size of every case')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--output', default=None, help='write the results to this json file')
+    parser.add_argument('--save-baseline', default=None, help='write the results as a new baseline')
+    parser.add_argument('--baseline', default=None, help='baseline json file to compare against')
+    parser.add_argument('--metric', default='p50_ms', choices=LOWER_IS_BETTER + HIGHER_IS_BETTER)
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative regression')
+    parser.add_argument('--case-threshold', nargs=2, action='append', default=[], metavar=('CASE', 'THRESHOLD'),
+                        help='per case threshold, can be repeated')
+    args = parser.parse_args(argv)
+
+    # the suite is cpu only, keep torch from initializing cuda
+    os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+    sizes = list(QUICK_SIZES) if args.quick else args.sizes
+    results = run_benchmarks(args.filter, sizes, repeat=args.repeat, warmup=args.warmup, verbose=True)
+    for path in (args.output, args.save_baseline):
+        if path is not None:
+            save_results(results, path)
+    if args.baseline is None:
+        return 0
+    thresholds = dict((case, float(value)) for case, value in args.case_threshold)
+    regressions = compare(results, load_results(args.baseline), args.threshold, args.metric, thresholds)
+    for regression in regressions:
+        print('REGRESSION %(case)s: %(baseline).3f -> %(current).3f (x%(ratio).2f)' % regression)
+    if not regressions:
+        print('no regression against {}'.format(args.baseline))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
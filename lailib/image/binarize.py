@@ -1,6 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+
 import numpy as np
 import cv2
+from lailib.profiling import instrument
 
+@instrument
 def otsu_thresh(im):
     '''
     binarize image with otsu algorithm
@@ -10,6 +15,7 @@ def otsu_thresh(im):
     _, binarized = cv2.threshold(im, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
     return binarized
 
+@instrument
 def vanilla_thresh(im):
     '''
     binarize image with a fixed threshold (170)
@@ -18,3 +24,199 @@ def vanilla_thresh(im):
     '''
     _, binarized = cv2.threshold(im, 0, 170, cv2.THRESH_BINARY)
     return binarized
+
+def _otsu_from_histograms(hists):
+    '''
+    otsu thresholds from intensity histograms, same criterion as cv2.THRESH_OTSU
+    (pixels > threshold are foreground). When two thresholds have the same between class
+    variance (e.g. three equally frequent, equally spaced gray levels) float rounding decides
+    which one wins, here and in cv2, so such ties may resolve differently than cv2 does
+    :param hists(ndarray): (..., 256) histograms
+    :return: thresholds as int array of shape hists.shape[:-1]
+    '''
+    hists = np.asarray(hists, dtype=np.float64)
+    total = hists.sum(axis=-1, keepdims=True)
+    total[total == 0] = 1
+    prob = hists / total
+    omega = np.cumsum(prob, axis=-1)
+    mu = np.cumsum(prob * np.arange(256), axis=-1)
+    mu_total = mu[..., -1:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma_b = (mu_total * omega - mu) ** 2 / (omega * (1. - omega))
+    sigma_b[~np.isfinite(sigma_b)] = 0
+    return np.argmax(sigma_b, axis=-1)
+
+
+@instrument
+def intensity_histograms(ims):
+    '''
+    256 bin intensity histograms of many images in one bincount pass
+    :param ims(ndarray or list): (N, H, W) uint8 array or list of 2d uint8 arrays
+    :return: (N, 256) int64 histograms
+    '''
+    if isinstance(ims, np.ndarray):
+        if len(ims.shape) != 3 or ims.dtype != np.uint8:
+            raise TypeError('input image stack must be (N, H, W) uint8 ndarray')
+        n = ims.shape[0]
+        if n == 0:
+            return np.zeros((0, 256), dtype=np.int64)
+        flat = ims.reshape(n, -1).astype(np.int64)
+        flat += (np.arange(n, dtype=np.int64) * 256)[:, None]
+        flat = flat.ravel()
+    else:
+        for im in ims:
+            if len(im.shape) != 2 or im.dtype != np.uint8:
+                raise TypeError('input image must be gray scale image as uint8 ndarray')
+        n = len(ims)
+        if n == 0:
+            return np.zeros((0, 256), dtype=np.int64)
+        sizes = [im.size for im in ims]
+        flat = np.concatenate([im.ravel() for im in ims]).astype(np.int64)
+        flat += np.repeat(np.arange(n, dtype=np.int64) * 256, sizes)
+    return np.bincount(flat, minlength=n * 256).reshape(n, 256)
+
+
+@instrument
+def otsu_thresh_batch(ims, hists=None):
+    '''
+    binarize many images with otsu algorithm, histograms of all images are built in one
+    vectorized pass and all thresholds are computed at once. Results are the same as
+    otsu_thresh on every image, except for exact variance ties between two thresholds,
+    which may break differently (see _otsu_from_histograms).
+    :param ims(ndarray or list): (N, H, W) uint8 array or list of 2d uint8 arrays
+    :param hists(ndarray): optional precomputed (N, 256) histograms, e.g. from intensity_histograms
+    :return: binarized images (same layout as ims), (N,) int thresholds, (N, 256) histograms
+    '''
+    if hists is None:
+        hists = intensity_histograms(ims)
+    elif len(hists) != len(ims):
+        raise ValueError('got {} histograms for {} images'.format(len(hists), len(ims)))
+    thresholds = _otsu_from_histograms(hists)
+    if isinstance(ims, np.ndarray):
+        binarized = (ims > thresholds[:, None, None]).view(np.uint8) * np.uint8(255)
+    else:
+        binarized = [(im > thresh).view(np.uint8) * np.uint8(255) for im, thresh in zip(ims, thresholds)]
+    return binarized, thresholds, hists
+
+
+def _local_mean_std(region, rows, cols, window_size):
+    '''
+    mean and std over a window_size x window_size window (clipped at region border)
+    for the pixels region[rows][:, cols], using integral images
+    :param region(ndarray): 2d uint8 array, the tile plus its halo
+    :param rows(ndarray): row indices in region
+    :param cols(ndarray): col indices in region
+    :param window_size(int): odd window size
+    :return: mean, std as float64 arrays of shape (len(rows), len(cols))
+    '''
+    half = window_size // 2
+    integral, sq_integral = cv2.integral2(region, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+    row_lo = np.clip(rows - half, 0, region.shape[0])
+    row_hi = np.clip(rows + half + 1, 0, region.shape[0])
+    col_lo = np.clip(cols - half, 0, region.shape[1])
+    col_hi = np.clip(cols + half + 1, 0, region.shape[1])
+    count = np.outer(row_hi - row_lo, col_hi - col_lo).astype(np.float64)
+
+    def box_sum(table):
+        return (table[np.ix_(row_hi, col_hi)] - table[np.ix_(row_lo, col_hi)]
+                - table[np.ix_(row_hi, col_lo)] + table[np.ix_(row_lo, col_lo)])
+
+    mean = box_sum(integral) / count
+    var = box_sum(sq_integral) / count - mean ** 2
+    return mean, np.sqrt(np.maximum(var, 0))
+
+
+def _thresh_tile(im, out, box, method, window_size, k, r, fallback_thresh, min_contrast):
+    '''
+    binarize one tile of im into out
+    :param box(tuple): row_start, row_end, col_start, col_end of the tile
+    other params see tiled_thresh
+    :return: None
+    '''
+    row_start, row_end, col_start, col_end = box
+    if method == 'otsu':
+        tile = np.ascontiguousarray(im[row_start:row_end, col_start:col_end])
+        if fallback_thresh is not None and int(tile.max()) - int(tile.min()) < min_contrast:
+            _, binarized = cv2.threshold(tile, int(fallback_thresh), 255, cv2.THRESH_BINARY)
+        else:
+            _, binarized = cv2.threshold(tile, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        out[row_start:row_end, col_start:col_end] = binarized
+        return
+    # read the tile with a halo, so local windows of border pixels see their real neighbours
+    half = window_size // 2
+    halo_row_start = max(row_start - half, 0)
+    halo_col_start = max(col_start - half, 0)
+    region = np.ascontiguousarray(im[halo_row_start:min(row_end + half, im.shape[0]),
+                                     halo_col_start:min(col_end + half, im.shape[1])])
+    rows = np.arange(row_start - halo_row_start, row_end - halo_row_start)
+    cols = np.arange(col_start - halo_col_start, col_end - halo_col_start)
+    mean, std = _local_mean_std(region, rows, cols, window_size)
+    if method == 'sauvola':
+        thresh = mean * (1 + k * (std / r - 1))
+    else:
+        thresh = mean + k * std
+    tile = region[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    out[row_start:row_end, col_start:col_end] = np.where(tile > thresh, 255, 0)
+
+
+@instrument
+def tiled_thresh(im,
+                 tile_size=1024,
+                 method='otsu',
+                 window_size=31,
+                 k=None,
+                 r=128,
+                 min_contrast=0,
+                 workers=None,
+                 out=None):
+    '''
+    binarize a large image tile by tile, tiles are independent and processed in a thread pool.
+    memory stays bounded by the tile size, so im and out can be np.memmap arrays.
+    :param im(ndarray): uint8 gray scale numpy array (or memmap)
+    :param tile_size(int or tuple): tile height and width
+    :param method(str): 'otsu' (otsu threshold per tile), 'sauvola' or 'niblack' (local thresholds
+                    over window_size x window_size windows computed with integral images)
+    :param window_size(int): odd window size for sauvola and niblack
+    :param k(float): sauvola / niblack k, defaults to 0.2 for sauvola and -0.2 for niblack
+    :param r(float): sauvola dynamic range of the standard deviation
+    :param min_contrast(int): only for otsu, tiles whose max - min is lower than min_contrast
+                    (e.g. blank background) use the otsu threshold of the whole image instead
+    :param workers(int): number of threads, defaults to os.cpu_count()
+    :param out(ndarray): optional uint8 output array (or writable memmap) of the same shape as im
+    :return: binarized image as uint8 numpy array
+    '''
+    if len(im.shape) != 2 or im.dtype != np.uint8:
+        raise TypeError('input image must be gray scale image as uint8 ndarray')
+    if method not in ('otsu', 'sauvola', 'niblack'):
+        raise ValueError('method must be "otsu", "sauvola" or "niblack", got {}'.format(method))
+    if window_size < 1 or window_size % 2 == 0:
+        raise ValueError('window_size must be a positive odd integer')
+    if out is None:
+        out = np.empty(im.shape, dtype=np.uint8)
+    elif out.shape != im.shape or out.dtype != np.uint8:
+        raise ValueError('out must be uint8 ndarray of shape {}'.format(im.shape))
+    if k is None:
+        k = 0.2 if method == 'sauvola' else -0.2
+    tile_height, tile_width = (tile_size, tile_size) if isinstance(tile_size, int) else tile_size
+    height, width = im.shape
+    boxes = [(row, min(row + tile_height, height), col, min(col + tile_width, width))
+             for row in range(0, height, tile_height)
+             for col in range(0, width, tile_width)]
+
+    fallback_thresh = None
+    if method == 'otsu' and min_contrast > 0:
+        hist = np.zeros(256, dtype=np.int64)
+        for row_start, row_end, col_start, col_end in boxes:
+            hist += np.bincount(im[row_start:row_end, col_start:col_end].ravel(), minlength=256)
+        fallback_thresh = _otsu_from_histograms(hist)
+
+    workers = workers or os.cpu_count() or 1
+    args = (method, window_size, k, r, fallback_thresh, min_contrast)
+    if workers == 1 or len(boxes) == 1:
+        for box in boxes:
+            _thresh_tile(im, out, box, *args)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # list() re-raises errors from the workers
+            list(pool.map(lambda box: _thresh_tile(im, out, box, *args), boxes))
+    return out
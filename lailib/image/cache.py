@@ -0,0 +1,245 @@
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import uuid
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # windows, the cache directory is recounted on every put instead of locking a shared size file
+    fcntl = None
+
+SIZE_FILE = '.size'
+STATS_DIR = '.stats'
+# (cache id, pid) -> hit / miss counters of this process, worker processes also publish theirs
+# as STATS_DIR/<cache id>-<pid>.json so stats() of the process that created the cache sees them
+_process_counters = {}
+
+
+def _hash_source(source):
+    '''
+    content hash of an image source
+    :param source(str or bytes or ndarray): image path, encoded image bytes or decoded image
+    :return: hex digest
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(source, np.ndarray):
+        digest.update('{}{}'.format(source.dtype.str, source.shape).encode())
+        digest.update(np.ascontiguousarray(source).data)
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        digest.update(source)
+    else:
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PreprocessCache(object):
+    '''
+    content addressed on disk cache for preprocessed images. Entries are keyed on the hash of
+    the source content plus the preprocessing parameters and stored as .npy files that are
+    memory-mapped on read. Writes go through a temp file and os.replace, so many DataLoader
+    worker processes can share one cache directory. Reads refresh the entry mtime, and once the
+    directory grows over max_bytes the least recently used entries are evicted. The directory
+    size is tracked in a locked file shared by all processes, so the cap also holds when the
+    cache is used from a process pool or DataLoader workers.
+
+    usage:
+        cache = PreprocessCache('/data/cache', max_bytes=50 * 2 ** 30)
+        im = cache.get_or_compute(path, lambda p: preprocess(p), padding=2, height=32)
+    '''
+    def __init__(self, cache_dir, max_bytes=None, evict_ratio=0.9):
+        '''
+        :param cache_dir(str): cache directory, created if missing
+        :param max_bytes(int): size cap of the cache directory, None for unbounded
+        :param evict_ratio(float): eviction removes entries until size <= evict_ratio * max_bytes
+        '''
+        self.cache_dir = str(cache_dir)
+        self.max_bytes = max_bytes
+        self.evict_ratio = evict_ratio
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # identifies this cache object and its copies in worker processes
+        self._id = uuid.uuid4().hex
+        self._owner_pid = os.getpid()
+        if max_bytes is not None:
+            self._update_size()
+
+    @staticmethod
+    def make_key(source, **params):
+        '''
+        :param source(str or bytes or ndarray): image path, encoded image bytes or decoded image
+        :param params: preprocessing parameters (padding, height, threshold mode...), must be json serializable
+        :return: cache key
+        '''
+        param_str = json.dumps(params, sort_keys=True)
+        param_hash = hashlib.blake2b(param_str.encode(), digest_size=8).hexdigest()
+        return '{}-{}'.format(_hash_source(source), param_hash)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def _entries(self):
+        for sub_dir in os.listdir(self.cache_dir):
+            sub_path = os.path.join(self.cache_dir, sub_dir)
+            if not os.path.isdir(sub_path):
+                continue
+            for entry in os.scandir(sub_path):
+                if entry.name.endswith('.npy'):
+                    try:
+                        yield entry.path, entry.stat()
+                    except FileNotFoundError:
+                        # evicted by another process
+                        continue
+
+    def _update_size(self, delta=None, evict=False):
+        '''
+        update the size file shared by every process using the cache directory and evict when the
+        size goes over max_bytes. The file is locked meanwhile, so one process evicts at a time.
+        :param delta(int): bytes added to the stored size, None (or no fcntl) recounts the directory
+        :param evict(bool): evict even if the cache is not over max_bytes
+        :return: number of removed bytes
+        '''
+        fd = os.open(os.path.join(self.cache_dir, SIZE_FILE), os.O_RDWR | os.O_CREAT)
+        with os.fdopen(fd, 'r+') as f:
+            if fcntl is not None:
+                # released when the file is closed
+                fcntl.flock(f, fcntl.LOCK_EX)
+            stored = f.read().strip()
+            if delta is None or fcntl is None or not stored:
+                total = self.size()
+            else:
+                total = int(stored) + delta
+            removed = 0
+            if evict or total > self.max_bytes:
+                total, removed = self._evict_entries()
+            f.seek(0)
+            f.truncate()
+            f.write(str(total))
+        return removed
+
+    def _count(self, **deltas):
+        pid = os.getpid()
+        counters = _process_counters.setdefault((self._id, pid), collections.Counter())
+        counters.update(deltas)
+        if pid != self._owner_pid:
+            path = os.path.join(self.cache_dir, STATS_DIR, '{}-{}.json'.format(self._id, pid))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(counters, f)
+            os.replace(path + '.tmp', path)
+
+    def size(self):
+        '''
+        :return: total bytes of the cached entries
+        '''
+        return sum(stat.st_size for _, stat in self._entries())
+
+    def get(self, key):
+        '''
+        :param key(str): cache key from make_key
+        :return: memory-mapped read only array or None on miss
+        '''
+        path = self._path(key)
+        try:
+            arr = np.load(path, mmap_mode='r')
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            self._count(misses=1)
+            return None
+        self._count(hits=1, bytes_saved=arr.nbytes)
+        return arr
+
+    def put(self, key, arr):
+        '''
+        atomically store an array
+        :param key(str): cache key from make_key
+        :param arr(ndarray): preprocessed image
+        :return: None
+        '''
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            # a concurrent worker may have stored the same key already
+            replaced = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced = 0
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.ascontiguousarray(arr))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        written = os.path.getsize(path)
+        self._count(bytes_written=written)
+        if self.max_bytes is not None:
+            self._update_size(written - replaced)
+
+    def get_or_compute(self, source, compute, **params):
+        '''
+        :param source(str or bytes or ndarray): image source, hashed for the key and passed to compute
+        :param compute(function): compute(source) -> ndarray, called on a miss
+        :param params: preprocessing parameters that are part of the key
+        :return: cached or freshly computed array
+        '''
+        key = self.make_key(source, **params)
+        arr = self.get(key)
+        if arr is None:
+            arr = compute(source)
+            self.put(key, arr)
+        return arr
+
+    def _evict_entries(self):
+        '''
+        :return: (size after eviction, removed bytes)
+        '''
+        entries = sorted(self._entries(), key=lambda entry: entry[1].st_mtime)
+        total = sum(stat.st_size for _, stat in entries)
+        target = self.evict_ratio * self.max_bytes
+        removed = 0
+        for path, stat in entries:
+            if total - removed <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            removed += stat.st_size
+        return total - removed, removed
+
+    def evict(self):
+        '''
+        remove least recently used entries until the cache is under evict_ratio * max_bytes
+        :return: number of removed bytes
+        '''
+        return self._update_size(evict=True)
+
+    def stats(self):
+        '''
+        counters of this process and of the worker processes that received a copy of the cache
+        :return: dict of hits, misses, hit_rate, bytes_saved (bytes served from cache) and bytes_written
+        '''
+        pid = os.getpid()
+        counters = collections.Counter(_process_counters.get((self._id, pid), {}))
+        stats_dir = os.path.join(self.cache_dir, STATS_DIR)
+        own_file = '{}-{}.json'.format(self._id, pid)
+        names = os.listdir(stats_dir) if os.path.isdir(stats_dir) else []
+        for name in names:
+            if name.startswith(self._id + '-') and name.endswith('.json') and name != own_file:
+                try:
+                    with open(os.path.join(stats_dir, name)) as f:
+                        counters.update(json.load(f))
+                except FileNotFoundError:
+                    continue
+        lookups = counters['hits'] + counters['misses']
+        return {'hits': counters['hits'],
+                'misses': counters['misses'],
+                'hit_rate': float(counters['hits']) / lookups if lookups else 0.,
+                'bytes_saved': counters['bytes_saved'],
+                'bytes_written': counters['bytes_written']}
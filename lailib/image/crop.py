@@ -1,7 +1,82 @@
+import cv2
 import numpy as np
-from lailib.image.binarize import otsu_thresh
+from lailib.image.binarize import otsu_thresh, otsu_thresh_batch, _otsu_from_histograms
+from lailib.profiling import instrument
 
-def crop_boundary_and_padding(im, padding=0, binarized=None):
+
+def _parse_padding(padding):
+    '''
+    normalize padding argument to a list of [left, right, up, down]
+    :param padding(int or list of ints): padding argument of the crop functions
+    :return: list of size 4
+    '''
+    if isinstance(padding, int):
+        return [padding] * 4
+    elif not (isinstance(padding, list) and len(padding) == 4):
+        raise TypeError('padding in crop function must be int or list of size 4')
+    return padding
+
+
+def _check_gray(im, binarized):
+    '''
+    validate input image and its optional binarized mask
+    :param im(ndarray): input image
+    :param binarized(ndarray or None): binarized mask of im
+    :return: None
+    '''
+    if len(im.shape) != 2 or im.dtype != np.uint8:
+        raise TypeError('input image must be gray scale image as uint8 ndarray')
+    if not binarized is None:
+        if binarized.shape != im.shape:
+            raise ValueError('binarized image shape {} must meet in image shape {}'.format(binarized.shape, im.shape))
+        if binarized.dtype != np.uint8:
+            raise TypeError('binarized mask must be uint8 ndarray')
+
+
+def _boundary_from_projections(rows, cols):
+    '''
+    get [start, end) boundaries from boolean foreground projections, works on
+    a single image (1d projections) or a stack of images (2d projections, one row per image)
+    :param rows(ndarray): bool array, True where a row contains foreground
+    :param cols(ndarray): bool array, True where a column contains foreground
+    :return: row_start, row_end, col_start, col_end
+    '''
+    height = rows.shape[-1]
+    width = cols.shape[-1]
+    row_start = np.argmax(rows, axis=-1)
+    row_end = height - np.argmax(np.flip(rows, axis=-1), axis=-1)
+    col_start = np.argmax(cols, axis=-1)
+    col_end = width - np.argmax(np.flip(cols, axis=-1), axis=-1)
+    return row_start, row_end, col_start, col_end
+
+
+def _fill_padded(dst, cropped, padding):
+    '''
+    write cropped into a buffer that may hold stale data: only the padding strips
+    are zeroed, everything of dst outside the padded crop is zeroed as well
+    :param dst(ndarray): 2d buffer, at least as large as the padded crop
+    :param cropped(ndarray): cropped image
+    :param padding(list of ints): [left, right, up, down]
+    :return: view of dst holding the padded crop
+    '''
+    out_height = cropped.shape[0] + padding[2] + padding[3]
+    out_width = cropped.shape[1] + padding[0] + padding[1]
+    if dst.shape[0] < out_height or dst.shape[1] < out_width:
+        raise ValueError('out buffer shape {} is smaller than padded crop shape {}'.format(
+            dst.shape, (out_height, out_width)))
+    dst[out_height:, :] = 0
+    dst[:out_height, out_width:] = 0
+    final_out = dst[:out_height, :out_width]
+    final_out[:padding[2], :] = 0
+    final_out[out_height - padding[3]:, :] = 0
+    final_out[padding[2]: out_height - padding[3], :padding[0]] = 0
+    final_out[padding[2]: out_height - padding[3], out_width - padding[1]:] = 0
+    final_out[padding[2]: out_height - padding[3], padding[0]: out_width - padding[1]] = cropped
+    return final_out
+
+
+@instrument
+def crop_boundary_and_padding(im, padding=0, binarized=None, mode='copy', out=None):
     '''
     crop and padding objects and text imgs with pure black border, then padding.
     ex:
@@ -18,39 +93,37 @@ def crop_boundary_and_padding(im, padding=0, binarized=None):
     :param padding(int or list of ints): if padding is a scalar, padding will be applied to left, right, upside and downside of an image.
                     if padding is a list of size 4, each entry in the list corresponds to left, right, upside and
                     downside of an image.
-    :return: cropped image (uint8)
+    :param mode(str): 'copy' returns a new padded image, 'view' returns a view into im
+                    (padding must be 0), 'box' returns the bounding box only
+    :param out(ndarray): optional 2d uint8 buffer (e.g. a slot of a batch array) the padded crop is
+                    written into in 'copy' mode, the crop sits at its top left corner and the rest is zeroed
+    :return: cropped image (uint8), a view of out when out is given,
+             (row_start, row_end, col_start, col_end) in 'box' mode
     '''
-    if len(im.shape) != 2 or im.dtype != np.uint8:
-        raise TypeError('input image must be gray scale image as uint8 ndarray')
-    if not binarized is None:
-        if binarized.shape != im.shape:
-            raise ValueError('binarized image shape {} must meet in image shape {}'.format(binarized.shape, im.shape))
-        if binarized.dtype != np.uint8:
-            raise TypeError('binarized mask must be uint8 ndarray')
-    else:
+    if mode not in ('copy', 'view', 'box'):
+        raise ValueError('mode must be "copy", "view" or "box", got {}'.format(mode))
+    _check_gray(im, binarized)
+    if binarized is None:
         binarized = otsu_thresh(im)
-    if np.sum(binarized) == 0:
-        raise ValueError('In image for crop function is all zero')
-
-    if isinstance(padding, int):
-        padding = [padding] * 4
-    elif not (isinstance(padding, list) and len(padding) == 4):
-        raise TypeError('padding in crop function must be int or list of size 4')
-
     # use binarized image to get vertical and horizontal boundaries
-    col_sums = np.sum(binarized, axis=1)
-    row_start = np.where(col_sums)[0][0]
-    rev_col_sum = np.flip(col_sums, axis=0)
-    rev_end = np.where(rev_col_sum)[0][0]
-    row_end = col_sums.shape[0] - rev_end
-
-    row_sums = np.sum(binarized, axis=0)
-    col_start = np.where(row_sums)[0][0]
-    rev_row_sum = np.flip(row_sums, axis=0)
-    rev_end = np.where(rev_row_sum)[0][0]
-    col_end = row_sums.shape[0] - rev_end
+    rows = np.any(binarized, axis=1)
+    if not rows.any():
+        raise ValueError('In image for crop function is all zero')
+    padding = _parse_padding(padding)
+    cols = np.any(binarized, axis=0)
+    row_start, row_end, col_start, col_end = _boundary_from_projections(rows, cols)
+    if mode == 'box':
+        return int(row_start), int(row_end), int(col_start), int(col_end)
 
     cropped = im[row_start:row_end, col_start:col_end]
+    if mode == 'view':
+        if any(padding):
+            raise ValueError('view mode of crop function can not apply padding')
+        return cropped
+    if out is not None:
+        if len(out.shape) != 2 or out.dtype != np.uint8:
+            raise TypeError('out buffer must be 2d uint8 ndarray')
+        return _fill_padded(out, cropped, padding)
 
     cropped_height, cropped_width = cropped.shape
     # TODO add rand noise to height
@@ -61,3 +134,254 @@ def crop_boundary_and_padding(im, padding=0, binarized=None):
     # do not directly use -padding as the value for end side because it can't deal with padding = 0
     final_out[padding[2]: out_height - padding[3], padding[0]: out_width - padding[1]] = cropped
     return final_out
+
+
+@instrument
+def crop_boundary_and_padding_batch(ims, padding=0, binarized=None, layout='padded', out=None):
+    '''
+    batched version of crop_boundary_and_padding. Bounding boxes of a (N, H, W) stack
+    are found in one vectorized pass, lists of variable size images are handled one
+    projection at a time. All padded crops are written into one preallocated output.
+    :param ims(ndarray or list): (N, H, W) uint8 array or list of 2d uint8 arrays
+    :param padding(int or list of ints): same as crop_boundary_and_padding, shared by all images
+    :param binarized(ndarray or list or None): masks with the same layout as ims,
+                    otsu threshold is used when None
+    :param layout(str): 'padded' returns (out, shapes), out is a zero filled (N, H', W') array,
+                    every crop sits at the top left corner of its slot.
+                    'packed' returns (buffer, offsets, shapes), image i is
+                    buffer[offsets[i]:offsets[i + 1]].reshape(shapes[i])
+    :param out(ndarray): optional preallocated (N, H, W) uint8 buffer for the 'padded' layout,
+                    H and W must be large enough for every padded crop, stale content is zeroed
+    :return: see layout, shapes is a (N, 2) int64 array of padded crop (height, width)
+    '''
+    if layout not in ('padded', 'packed'):
+        raise ValueError('layout must be "padded" or "packed", got {}'.format(layout))
+    padding = _parse_padding(padding)
+    boxes = crop_boxes_batch(ims, binarized)
+    return _write_crops(ims, boxes, padding, layout, out)
+
+
+def _write_crops(ims, boxes, padding, layout, out):
+    '''
+    copy box i of ims[i] into a padded or packed batch, see crop_boundary_and_padding_batch
+    :param ims(sequence): source image of every box
+    :param boxes(ndarray): (N, 4) [row_start, row_end, col_start, col_end)
+    :param padding(list of ints): [left, right, up, down]
+    :return: (out, shapes) or (buffer, offsets, shapes)
+    '''
+    shapes = np.stack([boxes[:, 1] - boxes[:, 0] + padding[2] + padding[3],
+                       boxes[:, 3] - boxes[:, 2] + padding[0] + padding[1]], axis=1)
+    n = len(boxes)
+
+    if layout == 'padded':
+        if out is not None:
+            if len(out.shape) != 3 or out.dtype != np.uint8 or len(out) != n:
+                raise TypeError('out buffer must be ({}, H, W) uint8 ndarray'.format(n))
+            for i, (row_start, row_end, col_start, col_end) in enumerate(boxes):
+                _fill_padded(out[i], ims[i][row_start:row_end, col_start:col_end], padding)
+            return out, shapes
+        out_height, out_width = (shapes.max(axis=0) if n else (0, 0))
+        out = np.zeros((n, out_height, out_width), dtype=np.uint8)
+        for i, (row_start, row_end, col_start, col_end) in enumerate(boxes):
+            out[i, padding[2]: shapes[i, 0] - padding[3], padding[0]: shapes[i, 1] - padding[1]] = \
+                ims[i][row_start:row_end, col_start:col_end]
+        return out, shapes
+
+    if out is not None:
+        raise ValueError('out buffer is only supported by the "padded" layout')
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(shapes[:, 0] * shapes[:, 1], out=offsets[1:])
+    buffer = np.zeros(offsets[-1], dtype=np.uint8)
+    for i, (row_start, row_end, col_start, col_end) in enumerate(boxes):
+        slot = buffer[offsets[i]:offsets[i + 1]].reshape(shapes[i])
+        slot[padding[2]: shapes[i, 0] - padding[3], padding[0]: shapes[i, 1] - padding[1]] = \
+            ims[i][row_start:row_end, col_start:col_end]
+    return buffer, offsets, shapes
+
+
+@instrument
+def crop_boxes_batch(ims, binarized=None):
+    '''
+    find foreground bounding boxes of many images
+    :param ims(ndarray or list): (N, H, W) uint8 array or list of 2d uint8 arrays
+    :param binarized(ndarray or list or None): masks with the same layout as ims,
+                    otsu threshold is used when None
+    :return: (N, 4) int64 array, each row is [row_start, row_end, col_start, col_end)
+    '''
+    if isinstance(ims, np.ndarray):
+        if len(ims.shape) != 3 or ims.dtype != np.uint8:
+            raise TypeError('input image stack must be (N, H, W) uint8 ndarray')
+        if binarized is None:
+            binarized, _, _ = otsu_thresh_batch(ims)
+        elif not isinstance(binarized, np.ndarray) or binarized.shape != ims.shape:
+            raise ValueError('binarized stack must be ndarray of shape {}'.format(ims.shape))
+        elif binarized.dtype != np.uint8:
+            raise TypeError('binarized mask must be uint8 ndarray')
+        rows = np.any(binarized, axis=2)
+        cols = np.any(binarized, axis=1)
+        if not rows.any(axis=1).all():
+            raise ValueError('In image for crop function is all zero')
+        return np.stack(_boundary_from_projections(rows, cols), axis=1).astype(np.int64)
+
+    if binarized is None:
+        binarized, _, _ = otsu_thresh_batch(ims)
+    elif len(binarized) != len(ims):
+        raise ValueError('got {} binarized masks for {} images'.format(len(binarized), len(ims)))
+    boxes = np.zeros((len(ims), 4), dtype=np.int64)
+    for i, im in enumerate(ims):
+        mask = binarized[i]
+        _check_gray(im, mask)
+        rows = np.any(mask, axis=1)
+        if not rows.any():
+            raise ValueError('In image for crop function is all zero')
+        boxes[i] = _boundary_from_projections(rows, np.any(mask, axis=0))
+    return boxes
+
+
+@instrument
+def region_boxes(binarized, merge_distance=0, min_area=1, connectivity=8):
+    '''
+    bounding boxes of all connected foreground regions, labelled in one pass
+    :param binarized(ndarray): 2d uint8 mask, nonzero pixels are foreground
+    :param merge_distance(int or tuple): regions separated by a gap of at most (horizontal, vertical)
+                    pixels are merged, e.g. (10, 0) merges characters into words / lines
+    :param min_area(int): components with fewer foreground pixels are dropped as noise
+    :param connectivity(int): 4 or 8
+    :return: (K, 4) int64 array of [row_start, row_end, col_start, col_end) in reading order
+    '''
+    num, labels, stats, _ = cv2.connectedComponentsWithStats(binarized, connectivity=connectivity)
+    # label 0 is background
+    keep = stats[:, cv2.CC_STAT_AREA] >= min_area
+    keep[0] = False
+    boxes = np.stack([stats[:, cv2.CC_STAT_TOP],
+                      stats[:, cv2.CC_STAT_TOP] + stats[:, cv2.CC_STAT_HEIGHT],
+                      stats[:, cv2.CC_STAT_LEFT],
+                      stats[:, cv2.CC_STAT_LEFT] + stats[:, cv2.CC_STAT_WIDTH]], axis=1).astype(np.int64)
+
+    merge_x, merge_y = (merge_distance, merge_distance) if isinstance(merge_distance, int) else merge_distance
+    if merge_x > 0 or merge_y > 0:
+        mask = keep[labels].astype(np.uint8) if not keep[1:].all() else binarized
+        # dilating right / down by the gap bridges gaps of at most merge_x / merge_y pixels
+        kernel = np.ones((merge_y + 1, merge_x + 1), dtype=np.uint8)
+        dilated = cv2.dilate(mask, kernel, anchor=(0, 0))
+        _, merged_labels = cv2.connectedComponents(dilated, connectivity=connectivity)
+        # every component lies inside one dilated component
+        group = np.zeros(num, dtype=np.int64)
+        foreground = mask > 0
+        group[labels[foreground]] = merged_labels[foreground]
+        group = group[keep]
+        merged = np.zeros((group.max() + 1 if len(group) else 0, 4), dtype=np.int64)
+        merged[:, 0::2] = np.iinfo(np.int64).max
+        np.minimum.at(merged[:, 0], group, boxes[keep, 0])
+        np.maximum.at(merged[:, 1], group, boxes[keep, 1])
+        np.minimum.at(merged[:, 2], group, boxes[keep, 2])
+        np.maximum.at(merged[:, 3], group, boxes[keep, 3])
+        boxes = merged[np.unique(group)]
+    else:
+        boxes = boxes[keep]
+    return boxes[np.lexsort((boxes[:, 2], boxes[:, 0]))]
+
+
+@instrument
+def crop_regions_and_padding(im, padding=0, binarized=None, merge_distance=0, min_area=1,
+                             connectivity=8, layout='padded', out=None):
+    '''
+    crop every connected foreground region (optionally merged into words or lines) of an image
+    with the padding semantics of crop_boundary_and_padding, all crops come back as one batch.
+    Replaces calling crop_boundary_and_padding on many sub-regions of a page.
+    :param im(ndarray): input image, uint8 numpy array, assumed to be gray scale
+    :param padding(int or list of ints): same as crop_boundary_and_padding, shared by all regions
+    :param binarized(ndarray): optional binarized mask of im, otsu threshold is used when None
+    :param merge_distance, min_area, connectivity: see region_boxes
+    :param layout(str), out(ndarray): see crop_boundary_and_padding_batch
+    :return: (out, shapes, boxes) for 'padded' layout or (buffer, offsets, shapes, boxes)
+             for 'packed' layout, boxes is the (K, 4) region_boxes output
+    '''
+    if layout not in ('padded', 'packed'):
+        raise ValueError('layout must be "padded" or "packed", got {}'.format(layout))
+    _check_gray(im, binarized)
+    if binarized is None:
+        binarized = otsu_thresh(im)
+    padding = _parse_padding(padding)
+    boxes = region_boxes(binarized, merge_distance, min_area, connectivity)
+    return _write_crops([im] * len(boxes), boxes, padding, layout, out) + (boxes,)
+
+
+def _open_gray(source, shape, offset):
+    '''
+    memory map a 2d uint8 image without reading it
+    :param source: ndarray (e.g. np.memmap), path to a .npy file or path to a raw file
+    :param shape: (height, width) of a raw file
+    :param offset: header bytes to skip in a raw file
+    :return: 2d uint8 ndarray backed by the file
+    '''
+    if isinstance(source, np.ndarray):
+        im = source
+    elif shape is None:
+        if not str(source).endswith('.npy'):
+            raise ValueError('shape is required for raw image files')
+        im = np.load(source, mmap_mode='r')
+    else:
+        im = np.memmap(source, dtype=np.uint8, mode='r', offset=offset, shape=tuple(shape))
+    _check_gray(im, None)
+    return im
+
+
+@instrument
+def crop_boundary_and_padding_chunked(source, padding=0, shape=None, offset=0, thresh=None, chunk_rows=1024,
+                                      mode='copy', out=None):
+    '''
+    out of core crop_boundary_and_padding for images too large for memory. The image is memory
+    mapped and streamed in chunks of rows: a first pass builds the intensity histogram for the otsu
+    threshold (skipped when thresh is given), a second pass thresholds every chunk on the fly and
+    keeps only the row and column foreground projections. Only the padded crop is copied out, so
+    memory scales with chunk_rows * width plus the output, not with the image.
+    Results are the same as crop_boundary_and_padding without a binarized mask, up to the otsu
+    tie caveat of otsu_thresh_batch.
+    :param source: 2d uint8 ndarray / np.memmap, path to a .npy file, or path to a raw uint8 file (needs shape)
+    :param padding(int or list of ints): same as crop_boundary_and_padding
+    :param shape: (height, width) of a raw file
+    :param offset(int): header bytes to skip in a raw file
+    :param thresh(int): pixels > thresh are foreground, None computes the otsu threshold of the whole image
+    :param chunk_rows(int): rows per chunk
+    :param mode(str): 'copy' returns the padded crop, 'box' returns the bounding box only
+    :param out(ndarray): optional 2d uint8 buffer, see crop_boundary_and_padding
+    :return: cropped image (uint8), a view of out when out is given,
+             (row_start, row_end, col_start, col_end) in 'box' mode
+    '''
+    if mode not in ('copy', 'box'):
+        raise ValueError('mode must be "copy" or "box", got {}'.format(mode))
+    if chunk_rows < 1:
+        raise ValueError('chunk_rows must be at least 1')
+    padding = _parse_padding(padding)
+    im = _open_gray(source, shape, offset)
+    height, width = im.shape
+    if thresh is None:
+        hist = np.zeros(256, dtype=np.int64)
+        for start in range(0, height, chunk_rows):
+            hist += np.bincount(im[start:start + chunk_rows].ravel(), minlength=256)
+        thresh = int(_otsu_from_histograms(hist))
+
+    rows = np.zeros(height, dtype=bool)
+    cols = np.zeros(width, dtype=bool)
+    mask = np.empty((min(chunk_rows, height), width), dtype=bool)
+    for start in range(0, height, chunk_rows):
+        chunk = im[start:start + chunk_rows]
+        chunk_mask = mask[:len(chunk)]
+        np.greater(chunk, thresh, out=chunk_mask)
+        np.any(chunk_mask, axis=1, out=rows[start:start + len(chunk)])
+        cols |= np.any(chunk_mask, axis=0)
+    del mask
+    if not rows.any():
+        raise ValueError('In image for crop function is all zero')
+    row_start, row_end, col_start, col_end = _boundary_from_projections(rows, cols)
+    if mode == 'box':
+        return int(row_start), int(row_end), int(col_start), int(col_end)
+
+    if out is not None:
+        if len(out.shape) != 2 or out.dtype != np.uint8:
+            raise TypeError('out buffer must be 2d uint8 ndarray')
+    else:
+        out = np.empty((row_end - row_start + padding[2] + padding[3],
+                        col_end - col_start + padding[0] + padding[1]), dtype=np.uint8)
+    return _fill_padded(out, im[row_start:row_end, col_start:col_end], padding)
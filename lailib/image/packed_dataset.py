@@ -0,0 +1,144 @@
+import os
+
+import numpy as np
+
+_INDEX_SUFFIX = '.idx.npy'
+_DATA_SUFFIX = '.bin'
+
+
+class PackedImageWriter(object):
+    '''
+    append variable size uint8 gray scale images into one contiguous binary file
+    (<prefix>.bin) plus an index of offset, height and width (<prefix>.idx.npy).
+    The index is written on close, images written before close are not visible to readers.
+
+    usage:
+        with PackedImageWriter('/data/train') as writer:
+            for im in images:
+                writer.append(crop_boundary_and_padding(im, 2))
+    '''
+    def __init__(self, prefix, mode='w'):
+        '''
+        :param prefix(str): output path without suffix
+        :param mode(str): 'w' to create / truncate, 'a' to append to an existing packed dataset
+        '''
+        if mode not in ('w', 'a'):
+            raise ValueError('mode must be "w" or "a", got {}'.format(mode))
+        self.prefix = str(prefix)
+        self._index = []
+        self._offset = 0
+        if mode == 'a' and os.path.exists(self.prefix + _INDEX_SUFFIX):
+            index = np.load(self.prefix + _INDEX_SUFFIX)
+            self._index = [index]
+            self._offset = int(index[-1, 0] + index[-1, 1] * index[-1, 2]) if len(index) else 0
+        self._file = open(self.prefix + _DATA_SUFFIX, 'r+b' if self._offset else 'wb')
+        self._file.truncate(self._offset)
+        self._file.seek(self._offset)
+
+    def append(self, im):
+        '''
+        :param im(ndarray): 2d uint8 image
+        :return: index of the image in the dataset
+        '''
+        if len(im.shape) != 2 or im.dtype != np.uint8:
+            raise TypeError('input image must be gray scale image as uint8 ndarray')
+        self._file.write(np.ascontiguousarray(im).data)
+        self._index.append(np.array([[self._offset, im.shape[0], im.shape[1]]], dtype=np.int64))
+        self._offset += im.size
+        return len(self) - 1
+
+    def extend(self, ims):
+        '''
+        :param ims(iterable): 2d uint8 images
+        :return: None
+        '''
+        for im in ims:
+            self.append(im)
+
+    def append_packed(self, buffer, offsets, shapes):
+        '''
+        append the 'packed' layout output of crop_boundary_and_padding_batch in one write
+        :param buffer(ndarray): 1d uint8 buffer
+        :param offsets(ndarray): (N + 1,) offsets into buffer
+        :param shapes(ndarray): (N, 2) image (height, width)
+        :return: None
+        '''
+        shapes = np.asarray(shapes, dtype=np.int64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if buffer.dtype != np.uint8 or len(offsets) != len(shapes) + 1 \
+                or not np.array_equal(np.diff(offsets), shapes[:, 0] * shapes[:, 1]):
+            raise ValueError('buffer, offsets and shapes do not describe a packed uint8 batch')
+        self._file.write(np.ascontiguousarray(buffer[offsets[0]:offsets[-1]]).data)
+        self._index.append(np.concatenate([(offsets[:-1] - offsets[0] + self._offset)[:, None], shapes], axis=1))
+        self._offset += int(offsets[-1] - offsets[0])
+
+    def __len__(self):
+        return sum(len(index) for index in self._index)
+
+    def close(self):
+        '''
+        flush the data file and atomically write the index
+        :return: None
+        '''
+        if self._file.closed:
+            return
+        self._file.close()
+        index = np.concatenate(self._index) if self._index else np.zeros((0, 3), dtype=np.int64)
+        tmp_path = self.prefix + '.idx.tmp.npy'
+        np.save(tmp_path, index)
+        os.replace(tmp_path, self.prefix + _INDEX_SUFFIX)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PackedImageDataset(object):
+    '''
+    random access reader of a PackedImageWriter output. Images are zero-copy read only
+    views into a memory map of the data file, so there is no per sample open() and many
+    worker processes share the page cache. The memory map is opened lazily in each process,
+    implements __getitem__ / __len__ so it can be used as a torch Dataset.
+    '''
+    def __init__(self, prefix, transform=None):
+        '''
+        :param prefix(str): path given to PackedImageWriter
+        :param transform(function): optional function applied to every image
+        '''
+        self.prefix = str(prefix)
+        self.transform = transform
+        self.index = np.load(self.prefix + _INDEX_SUFFIX)
+        self._data = None
+
+    @property
+    def shapes(self):
+        '''
+        :return: (N, 2) image (height, width), e.g. for WidthBucketSampler
+        '''
+        return self.index[:, 1:]
+
+    def _open(self):
+        if self._data is None:
+            if os.path.getsize(self.prefix + _DATA_SUFFIX) == 0:
+                self._data = np.zeros(0, dtype=np.uint8)
+            else:
+                self._data = np.memmap(self.prefix + _DATA_SUFFIX, dtype=np.uint8, mode='r')
+        return self._data
+
+    def __getstate__(self):
+        # do not pickle the memory map into DataLoader workers
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        offset, height, width = self.index[i]
+        im = self._open()[offset:offset + height * width].reshape(height, width)
+        if self.transform is not None:
+            return self.transform(im)
+        return im
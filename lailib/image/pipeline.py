@@ -0,0 +1,169 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+import os
+
+import cv2
+
+from lailib.image.binarize import otsu_thresh, vanilla_thresh
+from lailib.image.crop import crop_boundary_and_padding
+from lailib.image.resize_im import resize_height_keep_ratio
+
+PipelineResult = collections.namedtuple('PipelineResult', ['index', 'image', 'stage', 'error'])
+
+_BINARIZE_FUNCS = {'otsu': otsu_thresh, 'vanilla': vanilla_thresh}
+
+
+def _run_stages(index, item, config):
+    '''
+    run decode -> binarize -> crop -> resize on one item, module level so it can be
+    sent to process pools.
+    :param index(int): position of item in the input iterable
+    :param item(str or ndarray): image path or uint8 gray scale image
+    :param config(dict): stage parameters built by PreprocessPipeline
+    :return: PipelineResult, error is None on success, otherwise stage names the failed stage
+    '''
+    cache = config['cache']
+    stage = 'decode'
+    try:
+        if isinstance(item, (str, bytes, os.PathLike)):
+            item = os.fsdecode(item)
+        if cache is not None:
+            stage = 'cache'
+            key = cache.make_key(item, **config['cache_params'])
+            im = cache.get(key)
+            if im is not None:
+                return PipelineResult(index, im, None, None)
+            stage = 'decode'
+        if isinstance(item, str):
+            im = cv2.imread(item, cv2.IMREAD_GRAYSCALE)
+            if im is None:
+                raise IOError('can not decode image {}'.format(item))
+        else:
+            im = item
+        stage = 'binarize'
+        binarized = None
+        if config['binarize'] is not None:
+            binarized = _BINARIZE_FUNCS[config['binarize']](im)
+        stage = 'crop'
+        im = crop_boundary_and_padding(im, config['padding'], binarized=binarized)
+        if config['new_height'] is not None:
+            stage = 'resize'
+            im = resize_height_keep_ratio(im, config['new_height'], **config['resize_kwargs'])
+        if cache is not None:
+            stage = 'cache'
+            cache.put(key, im)
+    except Exception as e:
+        return PipelineResult(index, None, stage, e)
+    return PipelineResult(index, im, None, None)
+
+
+class PreprocessPipeline(object):
+    '''
+    streaming decode -> binarize -> crop -> resize pipeline over an iterable of image
+    paths or uint8 gray scale arrays. Items are processed in a thread or process pool,
+    at most max_pending items are in flight so memory stays bounded on huge inputs.
+
+    usage:
+        pipeline = PreprocessPipeline(padding=2, new_height=32, workers=8)
+        for res in pipeline.run(paths):
+            save(res.index, res.image)
+    '''
+    def __init__(self,
+                 padding=0,
+                 new_height=None,
+                 binarize='otsu',
+                 workers=None,
+                 executor='thread',
+                 ordered=True,
+                 max_pending=None,
+                 on_error='skip',
+                 cache=None,
+                 **resize_kwargs):
+        '''
+        :param padding(int or list of ints): padding passed to crop_boundary_and_padding
+        :param new_height(int): output height passed to resize_height_keep_ratio, None skips resizing
+        :param binarize(str): 'otsu', 'vanilla' or None (let the crop function binarize with otsu)
+        :param workers(int): pool size, defaults to os.cpu_count()
+        :param executor(str): 'thread' (cv2 releases the GIL) or 'process'
+        :param ordered(bool): if True results are yielded in input order, otherwise as soon as they finish
+        :param max_pending(int): max number of submitted but not yet yielded items, defaults to 4 * workers
+        :param on_error(str): 'skip' drops failed items (they are kept in self.errors),
+                    'yield' yields them as PipelineResult with image None, 'raise' re-raises the error
+        :param cache(PreprocessCache): optional cache, results are keyed on the source content and
+                    the stage parameters
+        :param resize_kwargs: passed to resize_height_keep_ratio
+        '''
+        if binarize is not None and binarize not in _BINARIZE_FUNCS:
+            raise ValueError('binarize must be one of {} or None'.format(sorted(_BINARIZE_FUNCS)))
+        if executor not in ('thread', 'process'):
+            raise ValueError('executor must be "thread" or "process", got {}'.format(executor))
+        if on_error not in ('skip', 'yield', 'raise'):
+            raise ValueError('on_error must be "skip", "yield" or "raise", got {}'.format(on_error))
+        self.config = {'padding': padding,
+                       'new_height': new_height,
+                       'binarize': binarize,
+                       'resize_kwargs': resize_kwargs,
+                       'cache': cache}
+        self.config['cache_params'] = {'padding': padding,
+                                       'new_height': new_height,
+                                       'binarize': binarize,
+                                       'resize_kwargs': resize_kwargs}
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = executor
+        self.ordered = ordered
+        self.max_pending = max_pending or 4 * self.workers
+        self.on_error = on_error
+        self.errors = []
+
+    def process(self, item):
+        '''
+        run the pipeline on a single item in the calling thread
+        :param item(str or ndarray): image path or uint8 gray scale image
+        :return: processed image
+        '''
+        res = _run_stages(0, item, self.config)
+        if res.error is not None:
+            raise res.error
+        return res.image
+
+    def _handle(self, res):
+        if res.error is None:
+            return True
+        if self.on_error == 'raise':
+            raise res.error
+        self.errors.append(res)
+        return self.on_error == 'yield'
+
+    def run(self, items):
+        '''
+        lazily process items
+        :param items(iterable): image paths or uint8 gray scale images, consumed lazily
+        :return: generator of PipelineResult
+        '''
+        pool_cls = ThreadPoolExecutor if self.executor == 'thread' else ProcessPoolExecutor
+        with pool_cls(max_workers=self.workers) as pool:
+            pending = collections.deque() if self.ordered else set()
+            items = iter(enumerate(items))
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < self.max_pending:
+                    try:
+                        index, item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    future = pool.submit(_run_stages, index, item, self.config)
+                    if self.ordered:
+                        pending.append(future)
+                    else:
+                        pending.add(future)
+                if not pending:
+                    return
+                if self.ordered:
+                    done = [pending.popleft()]
+                else:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    res = future.result()
+                    if self._handle(res):
+                        yield res
@@ -1,5 +1,8 @@
 import cv2
+import numpy as np
+from lailib.profiling import instrument
 
+@instrument
 def resize_height_keep_ratio(im, new_height, **kwargs):
     '''
     resize image with given height, keep ratio, kwargs are passed to
@@ -10,6 +13,109 @@ def resize_height_keep_ratio(im, new_height, **kwargs):
     '''
 
     (height, width) = im.shape
-    new_width = int(float(width) * new_height / float(height))
+    # tall narrow images keep at least one column
+    new_width = max(int(float(width) * new_height / float(height)), 1)
     im = cv2.resize(im, (new_width, new_height), **kwargs)
     return im
+
+def resized_widths(shapes, new_height):
+    '''
+    widths images would have after resize_height_keep_ratio, without resizing them
+    :param shapes(ndarray or list): (N, 2) image (height, width)
+    :param new_height(int): new height of the output images
+    :return: (N,) int64 widths, at least 1
+    '''
+    shapes = np.asarray(shapes, dtype=np.float64).reshape(-1, 2)
+    return np.maximum((shapes[:, 1] * new_height / shapes[:, 0]).astype(np.int64), 1)
+
+@instrument
+def resize_height_keep_ratio_batch(ims, new_height, pad_value=0, out=None, **kwargs):
+    '''
+    resize a batch of images to the same height keeping ratio and pack them into one
+    right padded array, kwargs are passed to cv2.resize function.
+    :param ims(list): 2d images, they should share one dtype
+    :param new_height(int): new height of the output images
+    :param pad_value: value right of every resized image
+    :param out(ndarray): optional preallocated (N, new_height, W) buffer, W must be at least the widest resized image
+    :return: (N, new_height, max width) array, (N,) int64 resized widths
+    '''
+    widths = resized_widths([im.shape for im in ims], new_height)
+    if out is None:
+        dtype = ims[0].dtype if len(ims) else np.uint8
+        out = np.full((len(ims), new_height, widths.max() if len(ims) else 0), pad_value, dtype=dtype)
+    else:
+        if out.shape[0] != len(ims) or out.shape[1] != new_height or (len(ims) and out.shape[2] < widths.max()):
+            raise ValueError('out buffer shape {} can not hold {} images of height {} and max width {}'.format(
+                out.shape, len(ims), new_height, widths.max() if len(ims) else 0))
+    for i, (im, width) in enumerate(zip(ims, widths)):
+        out[i, :, :width] = cv2.resize(im, (int(width), new_height), **kwargs)
+        out[i, :, width:] = pad_value
+    return out, widths
+
+class WidthBucketSampler(object):
+    '''
+    batch sampler that groups images of similar width after resizing, so little compute is
+    wasted on right padding. Images are sorted by resized width and cut greedily into batches
+    whose padded area (batch size * height * widest image) stays under max_batch_pixels.
+    Can be passed as batch_sampler to a torch DataLoader.
+    '''
+    def __init__(self, shapes, new_height, max_batch_pixels, max_batch_size=None, shuffle=True, seed=0):
+        '''
+        :param shapes(ndarray or list): (N, 2) original image (height, width)
+        :param new_height(int): height images are resized to
+        :param max_batch_pixels(int): memory budget of one padded batch in pixels
+        :param max_batch_size(int): optional cap on the number of images per batch
+        :param shuffle(bool): shuffle batch order (and order inside a width bucket) every epoch
+        :param seed(int): random seed, epoch i uses seed + i
+        '''
+        self.widths = resized_widths(shapes, new_height)
+        self.new_height = new_height
+        self.max_batch_pixels = max_batch_pixels
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        if len(self.widths) and self.widths.max() * new_height > max_batch_pixels:
+            raise ValueError('max_batch_pixels {} can not hold the widest image ({} x {})'.format(
+                max_batch_pixels, new_height, self.widths.max()))
+        self._batches = self._make_batches(np.random.RandomState(seed))
+
+    def _make_batches(self, rng):
+        # random tie breaking shuffles images of equal width between epochs
+        tie_break = rng.rand(len(self.widths)) if self.shuffle else np.arange(len(self.widths))
+        order = np.lexsort((tie_break, self.widths))
+        batches = []
+        batch = []
+        for index in order:
+            # sorted by width, so the current image is the widest of the batch
+            area = (len(batch) + 1) * self.new_height * self.widths[index]
+            full = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            if batch and (area > self.max_batch_pixels or full):
+                batches.append(batch)
+                batch = []
+            batch.append(int(index))
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def padded_area(self, batches=None):
+        '''
+        :param batches(list): list of index lists, defaults to the batches of the current epoch
+        :return: total padded area and total image area in pixels
+        '''
+        batches = self._batches if batches is None else batches
+        padded = sum(len(batch) * self.widths[batch].max() for batch in batches) * self.new_height
+        return int(padded), int(self.widths.sum() * self.new_height)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self._batches = self._make_batches(np.random.RandomState(self.seed + epoch))
+
+    def __iter__(self):
+        batches = list(self._batches)
+        if self.shuffle:
+            np.random.RandomState(self.seed + self.epoch).shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return len(self._batches)
@@ -1,11 +1,180 @@
-def load_json(json_path):
+import json
+import os
+from lailib.profiling import instrument, path_nbytes
+
+# optional faster parsers, picked automatically when installed
+try:
+    import orjson as _fast_json
+except ImportError:
+    try:
+        import ujson as _fast_json
+    except ImportError:
+        _fast_json = None
+
+JSON_BACKEND = _fast_json.__name__ if _fast_json is not None else 'json'
+
+_json_cache = {}
+_ARRAY_SEPARATORS = ' \t\r\n,]'
+# integers beyond 64 bits are parsed as floats by orjson, such documents go to the stdlib parser.
+# Digit runs are found on a translated copy where every digit is '0' and '.', 'e', 'E' are '.'
+_DIGIT_CLASSES = bytes.maketrans(b'123456789eE', b'000000000..')
+_LONG_RUN = b'0' * 19
+
+
+def _has_long_integer(raw):
+    '''
+    :param raw: json document as bytes
+    :return: True if it may contain an integer token of 19 or more digits, digit runs that
+             belong to a float (next to '.', 'e' or 'E', or to the sign of an
+             exponent) do not count
+    '''
+    classes = raw.translate(_DIGIT_CLASSES)
+    start = classes.find(_LONG_RUN)
+    while start != -1:
+        end = start + len(_LONG_RUN)
+        while end < len(classes) and classes[end] == ord('0'):
+            end += 1
+        # skip the sign of a number or of an exponent
+        before = start - 2 if start > 1 and classes[start - 1] in b'+-' else start - 1
+        if (before < 0 or classes[before] != ord('.')) and (end == len(classes) or classes[end] != ord('.')):
+            return True
+        start = classes.find(_LONG_RUN, end)
+    return False
+
+
+def _loads(s):
+    '''
+    parse with the fast backend when it gives the same result as the stdlib json module,
+    documents it rejects (NaN, Infinity, lone surrogates, ...) or may change (huge integers)
+    are parsed by json.loads
+    '''
+    if _fast_json is not None:
+        raw = s.encode('utf-8', 'surrogatepass') if isinstance(s, str) else s
+        if not _has_long_integer(raw):
+            try:
+                return _fast_json.loads(s)
+            except ValueError:
+                pass
+    return json.loads(s)
+
+
+@instrument(nbytes=path_nbytes)
+def load_json(json_path, cache=False):
     '''
     load one json file
     :param json_path: path to the json file, based on
     variable name the json file is assumed to be a
     dictionary.
+    :param cache: if set to true, the parsed object is memoized for this process, keyed
+    by path, mtime and size, so repeated loads of an unchanged file are free. The same
+    object is returned to every caller, do not modify it.
     :return: load dictionary
     '''
-    with open(json_path, 'r') as f:
-        ret_dict = json.load(f)
-    return ret_dict
\ No newline at end of file
+    if cache:
+        stat = os.stat(json_path)
+        key = os.path.abspath(json_path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = _json_cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+    with open(json_path, 'rb') as f:
+        ret_dict = _loads(f.read())
+    if cache:
+        _json_cache[key] = (version, ret_dict)
+    return ret_dict
+
+
+def clear_json_cache():
+    '''
+    drop every object memoized by load_json(cache=True)
+    :return: None
+    '''
+    _json_cache.clear()
+
+
+def iter_jsonl(jsonl_path):
+    '''
+    iterate records of a json lines file, one line is parsed at a time
+    so memory does not grow with the file size. Blank lines are skipped.
+    :param jsonl_path: path to the jsonl file
+    :return: generator of records
+    '''
+    with open(jsonl_path, 'rb') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield _loads(line)
+            except ValueError as e:
+                raise ValueError('invalid json in {} line {}: {}'.format(jsonl_path, line_number, e))
+
+
+def iter_json_array(json_path, chunk_size=1 << 20):
+    '''
+    iterate elements of a file holding one top level json array without
+    loading the whole file, memory is bounded by chunk_size plus the largest element.
+    :param json_path: path to the json file
+    :param chunk_size: number of characters read at a time
+    :return: generator of array elements
+    '''
+    decoder = json.JSONDecoder()
+    with open(json_path, 'r', encoding='utf-8') as f:
+        buf = ''
+
+        def fill(size=chunk_size):
+            chunk = f.read(size)
+            return chunk, not chunk
+
+        # find the opening bracket
+        while True:
+            chunk, eof = fill()
+            buf += chunk
+            stripped = buf.lstrip()
+            if stripped or eof:
+                break
+        if not stripped.startswith('['):
+            raise ValueError('{} does not contain a top level json array'.format(json_path))
+        buf = stripped
+        pos = 1
+        expect_value = True
+        first = True
+        while True:
+            # skip whitespace
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos == len(buf):
+                if eof:
+                    raise ValueError('unexpected end of json array in {}'.format(json_path))
+                chunk, eof = fill()
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            # "]" closes the array after a value or right after "[", not after a ","
+            if buf[pos] == ']' and (not expect_value or first):
+                return
+            if buf[pos] == ',' and not expect_value:
+                pos += 1
+                expect_value = True
+                continue
+            if not expect_value:
+                raise ValueError('expected "," or "]" in json array in {}'.format(json_path))
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                value, end = None, None
+            # a value not followed by a separator (e.g. "12" of "12e3") may continue in the next chunk
+            if end is None or (not eof and (end == len(buf) or buf[end] not in _ARRAY_SEPARATORS)):
+                if eof:
+                    raise ValueError('invalid json array element in {}'.format(json_path))
+                # grow the read size with the element so huge elements are not decoded over and over
+                chunk, eof = fill(max(chunk_size, len(buf) - pos))
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            yield value
+            pos = end
+            expect_value = False
+            first = False
+            if pos > chunk_size:
+                buf = buf[pos:]
+                pos = 0
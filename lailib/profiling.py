@@ -0,0 +1,244 @@
+'''
+opt-in instrumentation of the public lailib functions
+
+functions decorated with instrument record call counts, wall time, bytes produced
+(or read / written for i/o functions) and input shapes while profiling is enabled.
+When disabled a decorated call costs one flag check.
+
+usage:
+    with profiling():
+        crop_boundary_and_padding(im, 8)
+    print(get_stats()['lailib.image.crop.crop_boundary_and_padding'])
+    save_chrome_trace('trace.json')  # open in chrome://tracing or perfetto
+
+or for a whole process: LAILIB_PROFILE=1, with LAILIB_PROFILE_TRACE=<path> the chrome
+trace is written at exit. Statistics are per process, process pool workers keep their own.
+'''
+import atexit
+import collections
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+MAX_SAMPLES = 10000
+MAX_EVENTS = 100000
+MAX_SHAPES = 32
+
+_enabled = False
+_lock = threading.Lock()
+_records = {}
+_events = collections.deque(maxlen=MAX_EVENTS)
+_origin = time.perf_counter()
+
+
+class _Record(object):
+    __slots__ = ('count', 'total', 'max', 'samples', 'nbytes', 'shapes')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        # latest durations, percentiles are computed over this window
+        self.samples = collections.deque(maxlen=MAX_SAMPLES)
+        self.nbytes = 0
+        self.shapes = collections.Counter()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    '''
+    drop all recorded statistics and trace events
+    :return: None
+    '''
+    with _lock:
+        _records.clear()
+        _events.clear()
+
+
+@contextlib.contextmanager
+def profiling(reset_stats=False):
+    '''
+    enable instrumentation inside the with block, the previous state is restored on exit
+    :param reset_stats: if set to true, statistics recorded before are dropped
+    '''
+    global _enabled
+    previous = _enabled
+    if reset_stats:
+        reset()
+    _enabled = True
+    try:
+        yield
+    finally:
+        _enabled = previous
+
+
+def _nbytes(obj):
+    nbytes = getattr(obj, 'nbytes', None)
+    if isinstance(nbytes, int):
+        return nbytes
+    if hasattr(obj, 'element_size') and hasattr(obj, 'numel'):
+        return obj.element_size() * obj.numel()
+    if isinstance(obj, (tuple, list)):
+        return sum(_nbytes(item) for item in obj)
+    if isinstance(obj, dict):
+        return sum(_nbytes(item) for item in obj.values())
+    return 0
+
+
+def result_nbytes(result, args, kwargs):
+    '''
+    default byte count: size of the arrays and tensors returned, also inside (nested) tuples, lists and dicts
+    '''
+    return _nbytes(result)
+
+
+def path_nbytes(result, args, kwargs):
+    '''
+    byte count of i/o functions, size of the file returned or else of the first file among the arguments
+    '''
+    for arg in [result] + list(args) + list(kwargs.values()):
+        if isinstance(arg, (str, os.PathLike)) and os.path.isfile(arg):
+            return os.path.getsize(arg)
+    return 0
+
+
+def state_nbytes(result, args, kwargs):
+    '''
+    byte count of checkpoint functions, size of the state dict of the first argument that has one
+    '''
+    for arg in args:
+        if hasattr(arg, 'state_dict'):
+            return _nbytes(dict(arg.state_dict()))
+    return 0
+
+
+def _input_shape(args):
+    for arg in args:
+        shape = getattr(arg, 'shape', None)
+        if shape is not None:
+            return tuple(shape)
+        if isinstance(arg, (list, tuple)) and arg and getattr(arg[0], 'shape', None) is not None:
+            return (len(arg),) + tuple(arg[0].shape)
+    return None
+
+
+def _record(name, start, duration, nbytes, shape):
+    with _lock:
+        record = _records.get(name)
+        if record is None:
+            record = _records[name] = _Record()
+        record.count += 1
+        record.total += duration
+        record.max = max(record.max, duration)
+        record.samples.append(duration)
+        record.nbytes += nbytes
+        if shape is not None:
+            key = 'x'.join(str(dim) for dim in shape)
+            if key in record.shapes or len(record.shapes) < MAX_SHAPES:
+                record.shapes[key] += 1
+            else:
+                record.shapes['other'] += 1
+        _events.append((name, start, duration, threading.get_ident(), nbytes, shape))
+
+
+def instrument(fn=None, name=None, nbytes=result_nbytes):
+    '''
+    decorator recording calls of fn while profiling is enabled
+    :param fn: function to wrap
+    :param name: name in the statistics, defaults to <module>.<qualname>
+    :param nbytes: callable(result, args, kwargs) -> bytes produced, read or written by the call
+    :return: wrapped function
+    '''
+    if fn is None:
+        return functools.partial(instrument, name=name, nbytes=nbytes)
+    record_name = name or '%s.%s' % (fn.__module__, fn.__qualname__)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return fn(*args, **kwargs)
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        duration = time.perf_counter() - start
+        _record(record_name, start, duration, nbytes(result, args, kwargs), _input_shape(args))
+        return result
+    return wrapper
+
+
+def _percentile(samples, q):
+    '''
+    linearly interpolated percentile of sorted samples, same as numpy.percentile
+    '''
+    position = (len(samples) - 1) * q / 100.
+    low = int(position)
+    high = min(low + 1, len(samples) - 1)
+    return samples[low] + (samples[high] - samples[low]) * (position - low)
+
+
+def get_stats():
+    '''
+    :return: dict of function name -> dict with count, total_ms, mean_ms, p50_ms, p90_ms,
+             p99_ms, max_ms, bytes and shapes (input shape -> calls)
+    '''
+    with _lock:
+        records = [(name, record.count, record.total, record.max, sorted(record.samples),
+                    record.nbytes, dict(record.shapes)) for name, record in _records.items()]
+    stats = {}
+    for name, count, total, longest, samples, nbytes, shapes in records:
+        p50, p90, p99 = (_percentile(samples, q) * 1e3 for q in (50, 90, 99))
+        stats[name] = {'count': count,
+                       'total_ms': total * 1e3,
+                       'mean_ms': total / count * 1e3,
+                       'p50_ms': p50,
+                       'p90_ms': p90,
+                       'p99_ms': p99,
+                       'max_ms': longest * 1e3,
+                       'bytes': nbytes,
+                       'shapes': shapes}
+    return stats
+
+
+def chrome_trace():
+    '''
+    recorded calls as complete events of the chrome trace event format
+    :return: dict with 'traceEvents', json serializable
+    '''
+    with _lock:
+        events = list(_events)
+    pid = os.getpid()
+    trace_events = []
+    for name, start, duration, tid, nbytes, shape in events:
+        args = {'bytes': nbytes}
+        if shape is not None:
+            args['shape'] = list(shape)
+        trace_events.append({'name': name.rsplit('.', 1)[-1], 'cat': name.rsplit('.', 1)[0], 'ph': 'X',
+                             'ts': (start - _origin) * 1e6, 'dur': duration * 1e6,
+                             'pid': pid, 'tid': tid, 'args': args})
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+
+def save_chrome_trace(path):
+    with open(path, 'w') as f:
+        json.dump(chrome_trace(), f)
+
+
+if os.environ.get('LAILIB_PROFILE', '0').lower() not in ('', '0', 'false', 'no'):
+    enable()
+    if os.environ.get('LAILIB_PROFILE_TRACE'):
+        atexit.register(save_chrome_trace, os.environ['LAILIB_PROFILE_TRACE'])
@@ -0,0 +1,210 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from lailib.torch.parameter_store import save_network, load_network
+
+
+class CheckpointManager(object):
+    '''
+    checkpoint directory index built on save_network / load_network. Every model keeps a
+    manifest (<model_name>.manifest.json) that is atomically replaced after each save and
+    stores the latest and best step, so lookups never list or parse the directory.
+    Old checkpoints are pruned by a retention policy, files are deleted in a background thread.
+    Only one process (the trainer) should save through a manager for a given model.
+
+    usage:
+        manager = CheckpointManager(save_dir, 'crnn', keep_last=5, keep_every=10000)
+        manager.save(network, optimizer, global_step, metric=val_loss)
+        network, optimizer, global_step = manager.load_latest(network, optimizer, use_gpu=True)
+    '''
+    def __init__(self,
+                 save_dir,
+                 model_name,
+                 keep_last=None,
+                 keep_every=None,
+                 metric_mode='min',
+                 background=True):
+        '''
+        :param save_dir: path to the checkpoint directory
+        :param model_name: name of the model, same restrictions as save_network
+        :param keep_last: keep the N most recent checkpoints
+        :param keep_every: keep checkpoints whose global_step is a multiple of K. Checkpoints kept by
+                           neither rule are pruned, the latest and the best one are always kept,
+                           with both rules None nothing is pruned
+        :param metric_mode: 'min' or 'max', which metric value is the best one
+        :param background: if set to true, pruned files are deleted in a background thread
+        '''
+        if '_' in model_name or '.' in model_name:
+            raise ValueError('model name can not contain "." or "_"')
+        if metric_mode not in ('min', 'max'):
+            raise ValueError('metric_mode must be "min" or "max", got {}'.format(metric_mode))
+        self.save_dir = str(save_dir)
+        self.model_name = model_name
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.metric_mode = metric_mode
+        self.manifest_path = os.path.join(self.save_dir, '%s.manifest.json' % model_name)
+        self._executor = ThreadPoolExecutor(max_workers=1) if background else None
+        self._pending = []
+        self.manifest = self._read_manifest()
+
+    def _read_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                return json.load(f)
+        return self.rebuild_manifest()
+
+    def _write_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+
+    def checkpoint_path(self, global_step):
+        return os.path.join(self.save_dir, '%s_%s.pth' % (self.model_name, global_step))
+
+    def rebuild_manifest(self):
+        '''
+        build the manifest from the checkpoint files of this model, used for directories
+        written before the manager existed, costs one directory listing
+        :return: manifest dict
+        '''
+        prefix = self.model_name + '_'
+        steps = []
+        if os.path.isdir(self.save_dir):
+            for f in os.listdir(self.save_dir):
+                if f.startswith(prefix) and f.endswith('.pth') and f[len(prefix):-4].isdigit():
+                    steps.append(int(f[len(prefix):-4]))
+        steps.sort()
+        self.manifest = {'model_name': self.model_name,
+                         'latest': steps[-1] if steps else None,
+                         'best': None,
+                         'checkpoints': [{'global_step': step, 'metric': None} for step in steps]}
+        return self.manifest
+
+    def latest_step(self):
+        '''
+        :return: global step of the latest checkpoint, None if there is no checkpoint
+        '''
+        return self.manifest['latest']
+
+    def best_step(self):
+        '''
+        :return: global step of the checkpoint with the best metric, None if no metric was recorded
+        '''
+        best = self.manifest['best']
+        return None if best is None else best['global_step']
+
+    def save(self, network, optimizer, global_step, metric=None, use_gpu=True):
+        '''
+        save a checkpoint with save_network, update the manifest and apply the retention policy
+        :param network: the pytorch neural network that should be saved
+        :param optimizer: the optimizer for network training
+        :param global_step: integer step of the checkpoint
+        :param metric: optional number used to track the best checkpoint
+        :param use_gpu: passed to save_network
+        :return: path of the saved checkpoint
+        '''
+        global_step = int(global_step)
+        save_network(network, optimizer, self.save_dir, self.model_name, global_step, use_gpu=use_gpu)
+        checkpoints = [c for c in self.manifest['checkpoints'] if c['global_step'] != global_step]
+        checkpoints.append({'global_step': global_step, 'metric': metric})
+        checkpoints.sort(key=lambda c: c['global_step'])
+        self.manifest['checkpoints'] = checkpoints
+        self.manifest['latest'] = checkpoints[-1]['global_step']
+        best = self.manifest['best']
+        if best is not None and best['global_step'] == global_step:
+            # the best checkpoint was overwritten, its new metric may be worse than others
+            self.manifest['best'] = self._best_of(checkpoints)
+        elif metric is not None and (best is None or self._better(metric, best['metric'])):
+            self.manifest['best'] = {'global_step': global_step, 'metric': metric}
+        removed = self._apply_retention()
+        self._write_manifest()
+        # delete files only after the manifest no longer references them
+        self._delete(removed)
+        return self.checkpoint_path(global_step)
+
+    def _better(self, metric, other):
+        return metric < other if self.metric_mode == 'min' else metric > other
+
+    def _best_of(self, checkpoints):
+        best = None
+        for c in checkpoints:
+            if c['metric'] is not None and (best is None or self._better(c['metric'], best['metric'])):
+                best = {'global_step': c['global_step'], 'metric': c['metric']}
+        return best
+
+    def _apply_retention(self):
+        if self.keep_last is None and self.keep_every is None:
+            return []
+        checkpoints = self.manifest['checkpoints']
+        keep = set()
+        if self.keep_last is not None and self.keep_last > 0:
+            keep.update(c['global_step'] for c in checkpoints[-self.keep_last:])
+        if self.keep_every is not None:
+            keep.update(c['global_step'] for c in checkpoints if c['global_step'] % self.keep_every == 0)
+        keep.add(self.manifest['latest'])
+        if self.manifest['best'] is not None:
+            keep.add(self.manifest['best']['global_step'])
+        self.manifest['checkpoints'] = [c for c in checkpoints if c['global_step'] in keep]
+        return [c['global_step'] for c in checkpoints if c['global_step'] not in keep]
+
+    def _delete(self, steps):
+        paths = [self.checkpoint_path(step) for step in steps]
+        if not paths:
+            return
+        if self._executor is None:
+            _remove_files(paths)
+        else:
+            self._pending = [future for future in self._pending if not future.done()]
+            self._pending.append(self._executor.submit(_remove_files, paths))
+
+    def wait(self):
+        '''
+        block until background deletions are finished
+        :return: None
+        '''
+        for future in self._pending:
+            future.result()
+        self._pending = []
+
+    def close(self):
+        self.wait()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def load_latest(self, network, optimizer, use_gpu, reset_optimizer=False):
+        '''
+        load the latest checkpoint, same semantic as load_last_checkpoint
+        :return: network, optimizer, global step (0 if there is no checkpoint)
+        '''
+        global_step = self.latest_step()
+        if global_step is None:
+            print('first iteration, initialize model')
+            return network, optimizer, 0
+        network, optimizer = load_network(network, optimizer, self.save_dir, self.model_name,
+                                          global_step, use_gpu, reset_optimizer)
+        return network, optimizer, global_step
+
+    def load_best(self, network, optimizer, use_gpu, reset_optimizer=False):
+        '''
+        load the checkpoint with the best metric
+        :return: network, optimizer, global step of the best checkpoint
+        '''
+        global_step = self.best_step()
+        if global_step is None:
+            raise ValueError('no checkpoint of model {} has a metric'.format(self.model_name))
+        network, optimizer = load_network(network, optimizer, self.save_dir, self.model_name,
+                                          global_step, use_gpu, reset_optimizer)
+        return network, optimizer, global_step
+
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,142 @@
+import hashlib
+import os
+import zlib
+
+import numpy as np
+import torch
+
+from lailib.torch.tensor_file import TensorFile, flatten_state, save_state, save_tensors, unflatten_state, \
+    _tensor_bytes
+from lailib.profiling import instrument
+
+BASE_EXTENSION = '.tensors'
+DELTA_EXTENSION = '.delta'
+
+
+def _digest(array):
+    return hashlib.blake2b(np.ascontiguousarray(array).reshape(-1).view(np.uint8).data, digest_size=16).hexdigest()
+
+
+class DeltaCheckpointer(object):
+    '''
+    incremental checkpoints in the tensor file format. Every full_every saves a full base
+    checkpoint (<model_name>_<step>.tensors, a normal fmt='tensors' checkpoint) is written,
+    in between a delta file (<model_name>_<step>.delta) stores only the tensors whose content
+    changed since the base. With diff='xor' changed tensors are stored as the zlib compressed
+    xor against the base bytes, which is small when weights move slowly.
+    load_network(..., fmt='delta') rebuilds any step from its base and delta.
+
+    usage:
+        checkpointer = DeltaCheckpointer(save_dir, model_name, full_every=20)
+        checkpointer.save(network, optimizer, global_step)
+    '''
+    def __init__(self, save_dir, model_name, full_every=10, diff=None, level=1):
+        '''
+        :param save_dir: path to the checkpoint directory
+        :param model_name: name of the model, same restrictions as save_network
+        :param full_every: write a full base checkpoint every N saves
+        :param diff: None stores changed tensors as they are, 'xor' stores compressed xor against the base
+        :param level: zlib compression level for diff='xor'
+        '''
+        if '_' in model_name or '.' in model_name:
+            raise ValueError('model name can not contain "." or "_"')
+        if diff not in (None, 'xor'):
+            raise ValueError('diff must be None or "xor", got {}'.format(diff))
+        if full_every < 1:
+            raise ValueError('full_every must be at least 1')
+        self.save_dir = str(save_dir)
+        self.model_name = model_name
+        self.full_every = full_every
+        self.diff = diff
+        self.level = level
+        self.base_step = None
+        self._base_hashes = None
+        self._base_file = None
+        self._saves_since_base = 0
+
+    def _path(self, global_step, extension):
+        return os.path.join(self.save_dir, '%s_%s%s' % (self.model_name, global_step, extension))
+
+    def save(self, network, optimizer, global_step):
+        '''
+        :param network: the pytorch neural network that should be saved
+        :param optimizer: the optimizer for network training
+        :param global_step: integer step of the checkpoint
+        :return: path of the written base or delta file
+        '''
+        state = {'state_dict': network.state_dict(), 'optimizer': optimizer.state_dict()}
+        tensors, skeleton = flatten_state(state)
+        arrays = dict((name, _tensor_bytes(tensor)) for name, tensor in tensors.items())
+        hashes = dict((name, _digest(array)) for name, array in arrays.items())
+
+        if self.base_step is None or self._saves_since_base >= self.full_every:
+            path = self._path(global_step, BASE_EXTENSION)
+            save_state(state, path, metadata={'hashes': hashes})
+            self.base_step = global_step
+            self._base_hashes = hashes
+            self._base_file = TensorFile(path) if self.diff is not None else None
+            self._saves_since_base = 1
+            return path
+
+        stored = {}
+        xor = {}
+        for name, tensor in tensors.items():
+            if self._base_hashes.get(name) == hashes[name]:
+                continue
+            base_entry = self._base_file.entries.get(name) if self._base_file is not None else None
+            if base_entry is not None and base_entry['nbytes'] == arrays[name].nbytes \
+                    and base_entry['shape'] == list(tensor.shape):
+                new_bytes = np.ascontiguousarray(arrays[name]).reshape(-1).view(np.uint8)
+                diff = np.bitwise_xor(new_bytes, self._base_file.raw(name))
+                compressed = bytearray(zlib.compress(diff.data, self.level))
+                stored[name] = torch.from_numpy(np.frombuffer(compressed, dtype=np.uint8))
+                xor[name] = {'dtype': base_entry['dtype'], 'shape': base_entry['shape']}
+            else:
+                stored[name] = tensor
+        path = self._path(global_step, DELTA_EXTENSION)
+        save_tensors(stored, path, metadata={'state': skeleton, 'base_step': self.base_step, 'xor': xor})
+        self._saves_since_base += 1
+        return path
+
+
+class _DeltaSource(object):
+    '''
+    tensor lookup for unflatten_state: tensors stored in the delta, xor diffs applied to
+    the base, everything else read from the base
+    '''
+    def __init__(self, delta_file, base_file):
+        self.delta_file = delta_file
+        self.base_file = base_file
+        self.xor = delta_file.metadata['xor']
+
+    def get(self, name, copy=False):
+        if name in self.xor:
+            diff = np.frombuffer(zlib.decompress(self.delta_file.raw(name)), dtype=np.uint8)
+            restored = np.bitwise_xor(diff, self.base_file.raw(name))
+            reference = self.base_file.get(name)
+            return torch.from_numpy(restored).view(reference.dtype).reshape(reference.shape)
+        if name in self.delta_file:
+            return self.delta_file.get(name, copy=copy)
+        return self.base_file.get(name, copy=copy)
+
+
+@instrument
+def load_delta_state(save_dir, model_name, global_step, keys=None, copy=False):
+    '''
+    rebuild the state of a step saved by DeltaCheckpointer
+    :param save_dir: where the checkpoint files sit
+    :param model_name: name of the model
+    :param global_step: step to load, either a base or a delta step
+    :param keys: optional list of top level keys, e.g. ['state_dict']
+    :param copy: see TensorFile.get
+    :return: dict with 'state_dict' and 'optimizer'
+    '''
+    prefix = os.path.join(str(save_dir), '%s_%s' % (model_name, global_step))
+    if os.path.exists(prefix + BASE_EXTENSION):
+        base_file = TensorFile(prefix + BASE_EXTENSION)
+        return unflatten_state(base_file.metadata['state'], base_file, keys, copy)
+    delta_file = TensorFile(prefix + DELTA_EXTENSION)
+    base_path = os.path.join(str(save_dir), '%s_%s%s' % (model_name, delta_file.metadata['base_step'],
+                                                          BASE_EXTENSION))
+    source = _DeltaSource(delta_file, TensorFile(base_path))
+    return unflatten_state(delta_file.metadata['state'], source, keys, copy)
@@ -1,17 +1,32 @@
+import collections
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait
 import torch
 import numpy as np
 from os import listdir
+from lailib.torch.tensor_file import save_state, load_state, load_options
+from lailib.torch.delta_checkpoint import load_delta_state
+from lailib.torch.sharded_checkpoint import save_sharded, load_sharded_state
+from lailib.profiling import instrument, path_nbytes, state_nbytes
+
+# checkpoint format -> file extensions, the first one is used for saving
+CHECKPOINT_FORMATS = {'pth': ('.pth',), 'tensors': ('.tensors',), 'delta': ('.delta', '.tensors'),
+                      'sharded': ('.shards',)}
 
 #TODO add support for optimizer tensor type
 #TODO add types for function heads
 #TODO support early stopping
+@instrument(nbytes=state_nbytes)
 def save_network(network,
                  optimizer,
                  save_dir,
                  model_name,
                  global_step,
-                 use_gpu=True):
+                 use_gpu=True,
+                 fmt='pth',
+                 storage_dtype=None,
+                 codec=None):
     '''
     save current neural network parameters and optimizer parameters
     currently the use_gpu flag only takes care of parameters in network,
@@ -26,26 +41,188 @@ def save_network(network,
                         had run, (usually steps is the number of iterations and
                         number of epoches)
     :param use_gpu: a parameter indicates if the input neural network is on gpu
+    :param fmt: 'pth' saves a torch pickle, 'tensors' saves the pickle free tensor file format
+                (see lailib.torch.tensor_file) that load_network reads lazily through a memory map,
+                the network is not moved between devices in this format.
+                'delta' checkpoints are written by lailib.torch.delta_checkpoint.DeltaCheckpointer.
+                'sharded' must be called on every torch.distributed rank, each rank writes a
+                slice of the state (see lailib.torch.sharded_checkpoint)
+    :param storage_dtype: only for fmt='tensors', torch.float16 or torch.bfloat16 to store the network
+                          weights in reduced precision, they are upcast again on load
+    :param codec: only for fmt='tensors', per tensor compression ('zlib', 'bz2' or 'lzma'),
+                  tensors are compressed in parallel
     :return: None
     '''
     if  '_' in model_name or '.' in model_name:
         raise ValueError('model name can not contain "." or "_"')
-    save_filename = '%s_%s.pth' % (model_name, global_step)
+    if fmt not in CHECKPOINT_FORMATS:
+        raise ValueError('checkpoint format must be one of {}'.format(sorted(CHECKPOINT_FORMATS)))
+    if fmt == 'delta':
+        raise ValueError('delta checkpoints must be saved with DeltaCheckpointer')
+    if fmt != 'tensors' and (storage_dtype is not None or codec is not None):
+        raise ValueError('storage_dtype and codec are only supported by the "tensors" format')
+    save_filename = '%s_%s%s' % (model_name, global_step, CHECKPOINT_FORMATS[fmt][0])
     save_path = os.path.join(save_dir, save_filename)
+    if fmt == 'sharded':
+        save_sharded(network, optimizer, save_dir, model_name, global_step)
+        return
+    if fmt == 'tensors':
+        save_state({'state_dict': network.state_dict(),
+                    'optimizer': optimizer.state_dict()}, save_path,
+                   storage_dtype=storage_dtype, downcast_prefix='state_dict.', codec=codec)
+        return
     state = {'state_dict': network.cpu().state_dict(),
              'optimizer': optimizer.state_dict()}
     torch.save(state, save_path)
     if use_gpu:
         network.cuda()
 
+def _snapshot(obj, buffers, key=()):
+    '''
+    copy every tensor of a (nested) state dict into reusable cpu buffers,
+    cuda tensors are copied asynchronously into pinned memory
+    :param obj: state dict, or any value inside it
+    :param buffers: dict of path in the state dict -> cpu tensor, reused between calls
+    :param key: path of obj in the state dict
+    :return: the same structure with tensors replaced by their buffers
+    '''
+    if torch.is_tensor(obj):
+        buf = buffers.get(key)
+        if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+            buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+            buffers[key] = buf
+        buf.copy_(obj.detach(), non_blocking=obj.is_cuda)
+        return buf
+    if isinstance(obj, dict):
+        return type(obj)((k, _snapshot(v, buffers, key + (k,))) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v, buffers, key + (i,)) for i, v in enumerate(obj))
+    return obj
+
+
+def _atomic_torch_save(state, save_path, cuda_event=None):
+    '''
+    torch.save into a temp file next to save_path, then rename it
+    :param state: object to save
+    :param save_path: final checkpoint path
+    :param cuda_event: optional cuda event to wait for before reading pinned buffers
+    :return: save_path
+    '''
+    if cuda_event is not None:
+        cuda_event.synchronize()
+    save_dir = os.path.dirname(os.path.abspath(save_path))
+    fd, tmp_path = tempfile.mkstemp(dir=save_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            torch.save(state, f)
+        os.replace(tmp_path, save_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return save_path
+
+
+class AsyncCheckpointSaver(object):
+    '''
+    non blocking version of save_network. The network and optimizer state is snapshotted
+    into reusable host buffers without moving the network, then written by a background
+    thread through a temp file and rename. At most max_in_flight saves are pending,
+    a new save blocks until the oldest one is done. Files have the save_network format,
+    so load_network and load_last_checkpoint read them.
+
+    usage:
+        saver = AsyncCheckpointSaver()
+        handle = saver.save(network, optimizer, save_dir, model_name, global_step)
+        ...
+        saver.wait()
+    '''
+    def __init__(self, max_in_flight=1):
+        '''
+        :param max_in_flight: max number of checkpoints being written at the same time,
+                              every in flight save holds one copy of the state in host memory
+        '''
+        if max_in_flight < 1:
+            raise ValueError('max_in_flight must be at least 1')
+        self.max_in_flight = max_in_flight
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._in_flight = collections.deque()
+        self._free_buffers = []
+
+    def _reclaim(self, block):
+        while self._in_flight and (block or self._in_flight[0][0].done()):
+            future, buffers = self._in_flight.popleft()
+            wait([future])
+            self._free_buffers.append(buffers)
+            block = False
+
+    def save(self, network, optimizer, save_dir, model_name, global_step):
+        '''
+        :param network: the pytorch neural network that should be saved
+        :param optimizer: the optimizer for network training
+        :param save_dir: path to the checkpoint directory
+        :param model_name: name of the model
+        :param global_step: An integer indicates how many steps the training had run
+        :return: concurrent.futures.Future, result() returns the checkpoint path or raises the write error
+        '''
+        if  '_' in model_name or '.' in model_name:
+            raise ValueError('model name can not contain "." or "_"')
+        self._reclaim(block=False)
+        if len(self._in_flight) >= self.max_in_flight:
+            self._reclaim(block=True)
+        buffers = self._free_buffers.pop() if self._free_buffers else ({}, {})
+        state = {'state_dict': _snapshot(network.state_dict(), buffers[0]),
+                 'optimizer': _snapshot(optimizer.state_dict(), buffers[1])}
+        cuda_event = None
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            cuda_event = torch.cuda.Event()
+            cuda_event.record()
+        save_path = os.path.join(save_dir, '%s_%s.pth' % (model_name, global_step))
+        future = self._executor.submit(_atomic_torch_save, state, save_path, cuda_event)
+        self._in_flight.append((future, buffers))
+        return future
+
+    def wait(self):
+        '''
+        block until every pending save is written, re-raises the first write error
+        :return: None
+        '''
+        futures = [future for future, _ in self._in_flight]
+        while self._in_flight:
+            self._reclaim(block=True)
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+
+
+def checkpoint_steps(save_dir, model_name, fmt='pth'):
+    '''
+    global steps of all checkpoints of a model
+    :param save_dir: where the checkpoint files sit
+    :param model_name: name of the model
+    :param fmt: checkpoint format, see save_network
+    :return: sorted list of global steps
+    '''
+    if fmt not in CHECKPOINT_FORMATS:
+        raise ValueError('checkpoint format must be one of {}'.format(sorted(CHECKPOINT_FORMATS)))
+    checkpoint_paths = [f for f in listdir(save_dir)
+                        if f.startswith(model_name + '_') and f.endswith(CHECKPOINT_FORMATS[fmt])]
+    raw_names = [f.split('.')[0] for f in checkpoint_paths]
+    return sorted(set(int(f.split('_')[1]) for f in raw_names))
+
+
 #TODO add support for optimizer tensor type
 
+@instrument(nbytes=state_nbytes)
 def load_last_checkpoint(network,
                          optimizer,
                          save_dir,
                          model_name,
                          use_gpu,
-                         reset_optimizer = False):
+                         reset_optimizer = False,
+                         fmt='pth'):
     '''
     load the latest checkpoint from checkpoint folder
     currently the use_gpu flag only takes cares of parameters in network,
@@ -57,16 +234,17 @@ def load_last_checkpoint(network,
     :param model_name: name of the model
     :param use_gpu: a parameter indicates if the output neural network is on gpu
     :reset_optimizer: if set to true, optimizer will not load parameters in checkpoint dict
+    :param fmt: checkpoint format, see save_network
     :return: network with loaded parameters, optimizer with loaded parameter, iternumber of last checkpoint
     '''
     if  '_' in model_name or '.' in model_name:
         raise ValueError('model name can not contain "." or "_"')
-    checkpoint_paths = [f for f in listdir(save_dir) if f.endswith('pth')]
-    if not checkpoint_paths:
+    if fmt not in CHECKPOINT_FORMATS:
+        raise ValueError('checkpoint format must be one of {}'.format(sorted(CHECKPOINT_FORMATS)))
+    iter_numbers = checkpoint_steps(save_dir, model_name, fmt)
+    if not iter_numbers:
         print('first iteration, initialize model')
-        return network, 0
-    raw_names = [f.split('.')[0] for f in checkpoint_paths]
-    iter_numbers = [int(f.split('_')[1]) for f in raw_names]
+        return network, optimizer, 0
     max_global_step = np.max(np.asarray(iter_numbers))
     network, optimizer = load_network(network,
                            optimizer,
@@ -74,17 +252,20 @@ def load_last_checkpoint(network,
                            model_name,
                            max_global_step,
                            use_gpu,
-                           reset_optimizer)
+                           reset_optimizer,
+                           fmt)
     return network, optimizer, max_global_step
 
 
+@instrument(nbytes=state_nbytes)
 def load_network(network,
                  optimizer,
                  save_dir,
                  model_name,
                  global_step,
                  use_gpu,
-                 reset_optimizer=False):
+                 reset_optimizer=False,
+                 fmt='pth'):
     '''
     load neural network parameters
     currently the use_gpu flag only takes cares of parameters in network,
@@ -98,15 +279,29 @@ def load_network(network,
                         had run, (usually steps is the number of iterations and
                         number of epoches)
     :param reset_optimizer: if set to true, optimizer will not load parameters in checkpoint dict
+    :param fmt: checkpoint format, see save_network. With 'tensors' the file is memory mapped
+                and optimizer tensors are not read at all when reset_optimizer is set,
+                'delta' rebuilds the step from its base and delta file,
+                'sharded' reads all shards in parallel, with any world size
 
     :return: network with loaded parameters, optimizer with loaded parameter,
     '''
     if  '_' in model_name or '.' in model_name:
         raise ValueError('model name can not contain "." or "_"')
+    if fmt not in CHECKPOINT_FORMATS:
+        raise ValueError('checkpoint format must be one of {}'.format(sorted(CHECKPOINT_FORMATS)))
     network.cpu()
-    save_filename = '%s_%s.pth' % (model_name, global_step)
+    save_filename = '%s_%s%s' % (model_name, global_step, CHECKPOINT_FORMATS[fmt][0])
     save_path = os.path.join(save_dir, save_filename)
-    state_dicts = torch.load(save_path)
+    keys = ['state_dict'] if reset_optimizer else None
+    if fmt == 'delta':
+        state_dicts = load_delta_state(save_dir, model_name, global_step, keys)
+    elif fmt == 'sharded':
+        state_dicts = load_sharded_state(save_dir, model_name, global_step, keys)
+    elif fmt == 'tensors':
+        state_dicts = load_state(save_path, keys)
+    else:
+        state_dicts = torch.load(save_path)
     network.load_state_dict(state_dicts['state_dict'])
     if use_gpu:
         network.cuda()
@@ -114,3 +309,135 @@ def load_network(network,
         optimizer.load_state_dict(state_dicts['optimizer'])
     print('load checkpoint from {}'.format(save_filename))
     return network, optimizer
+
+
+def checkpoint_options(save_dir, model_name, global_step, fmt='tensors'):
+    '''
+    storage options a checkpoint was saved with
+    :param save_dir: where the checkpoint file sits
+    :param model_name: name of the model
+    :param global_step: step of the checkpoint
+    :param fmt: checkpoint format, see save_network
+    :return: dict with format, storage_dtype, downcast_prefix and codec
+    '''
+    if fmt not in CHECKPOINT_FORMATS:
+        raise ValueError('checkpoint format must be one of {}'.format(sorted(CHECKPOINT_FORMATS)))
+    options = {'format': fmt, 'storage_dtype': None, 'downcast_prefix': None, 'codec': None}
+    for extension in CHECKPOINT_FORMATS[fmt]:
+        save_path = os.path.join(save_dir, '%s_%s%s' % (model_name, global_step, extension))
+        if fmt != 'pth' and os.path.exists(save_path):
+            options.update(load_options(save_path))
+            break
+    return options
+
+
+def _load_checkpoint_state(save_dir, model_name, global_step, fmt, keys):
+    '''
+    read one checkpoint without materializing it where the format allows:
+    'pth' files are memory mapped by torch.load, 'tensors' and 'delta' return views of the memory map
+    '''
+    if fmt == 'delta':
+        return load_delta_state(save_dir, model_name, global_step, keys)
+    if fmt == 'sharded':
+        return load_sharded_state(save_dir, model_name, global_step, keys)
+    save_path = os.path.join(save_dir, '%s_%s%s' % (model_name, global_step, CHECKPOINT_FORMATS[fmt][0]))
+    if fmt == 'tensors':
+        return load_state(save_path, keys)
+    try:
+        return torch.load(save_path, map_location='cpu', mmap=True)
+    except RuntimeError:
+        # legacy (non zip) torch files can not be memory mapped
+        return torch.load(save_path, map_location='cpu')
+
+
+@instrument(nbytes=path_nbytes)
+def average_checkpoints(save_dir,
+                        model_name,
+                        global_steps,
+                        output_step,
+                        mode='uniform',
+                        decay=0.9,
+                        fmt='pth',
+                        output_fmt=None,
+                        workers=None):
+    '''
+    average the network weights of several checkpoints (checkpoint averaging / SWA / EMA) and save
+    the result as a normal checkpoint. Checkpoints are read one after the other into a running
+    average that is updated tensor by tensor in a thread pool, so peak memory stays around one model
+    (plus the memory mapped checkpoint being read) regardless of the number of checkpoints.
+    Floating point tensors are accumulated in at least float32 and cast back to their dtype, other
+    tensors (e.g. num_batches_tracked) and the optimizer state are taken from the last checkpoint.
+
+    usage:
+        steps = checkpoint_steps(save_dir, 'crnn')[-5:]
+        average_checkpoints(save_dir, 'crnn', steps, output_step=steps[-1] + 1)
+
+    :param save_dir: where the checkpoint files sit
+    :param model_name: name of the model
+    :param global_steps: steps of the checkpoints to average, in training order
+    :param output_step: global step of the averaged checkpoint
+    :param mode: 'uniform' for the plain mean, 'ema' for an exponential moving average
+                 avg = decay * avg + (1 - decay) * weights over the steps in the given order
+    :param decay: decay of mode='ema'
+    :param fmt: checkpoint format of the inputs, see save_network
+    :param output_fmt: 'pth' or 'tensors', defaults to fmt for these two formats and 'tensors' otherwise
+    :param workers: threads updating tensors in parallel
+    :return: path of the averaged checkpoint
+    '''
+    if '_' in model_name or '.' in model_name:
+        raise ValueError('model name can not contain "." or "_"')
+    if fmt not in CHECKPOINT_FORMATS:
+        raise ValueError('checkpoint format must be one of {}'.format(sorted(CHECKPOINT_FORMATS)))
+    if output_fmt is None:
+        output_fmt = fmt if fmt in ('pth', 'tensors') else 'tensors'
+    if output_fmt not in ('pth', 'tensors'):
+        raise ValueError('output_fmt must be "pth" or "tensors", got {}'.format(output_fmt))
+    if mode not in ('uniform', 'ema'):
+        raise ValueError('mode must be "uniform" or "ema", got {}'.format(mode))
+    if mode == 'ema' and not 0 <= decay < 1:
+        raise ValueError('decay must be in [0, 1), got {}'.format(decay))
+    global_steps = list(global_steps)
+    if not global_steps:
+        raise ValueError('global_steps is empty')
+
+    average = collections.OrderedDict()
+    dtypes = {}
+
+    def init(tensor):
+        if tensor.is_floating_point():
+            return tensor.to(torch.promote_types(tensor.dtype, torch.float32), copy=True)
+        return tensor.clone()
+
+    def update(name, tensor):
+        if not dtypes[name].is_floating_point:
+            average[name].copy_(tensor)
+        elif mode == 'uniform':
+            average[name].add_(tensor)
+        else:
+            average[name].mul_(decay).add_(tensor, alpha=1 - decay)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for global_step in global_steps:
+            state_dict = _load_checkpoint_state(save_dir, model_name, global_step, fmt, ['state_dict'])['state_dict']
+            if not average:
+                names = list(state_dict)
+                dtypes.update((name, state_dict[name].dtype) for name in names)
+                average.update(zip(names, pool.map(init, [state_dict[name] for name in names])))
+            elif set(state_dict) != set(average):
+                raise ValueError('checkpoint {} of {} has different parameters'.format(global_step, model_name))
+            else:
+                list(pool.map(update, list(state_dict), list(state_dict.values())))
+            del state_dict
+
+    for name, dtype in dtypes.items():
+        if mode == 'uniform' and dtype.is_floating_point:
+            average[name].div_(len(global_steps))
+        average[name] = average[name].to(dtype)
+    optimizer = _load_checkpoint_state(save_dir, model_name, global_steps[-1], fmt, ['optimizer'])['optimizer']
+    save_path = os.path.join(save_dir, '%s_%s%s' % (model_name, output_step, CHECKPOINT_FORMATS[output_fmt][0]))
+    state = {'state_dict': average, 'optimizer': optimizer}
+    if output_fmt == 'tensors':
+        save_state(state, save_path)
+    else:
+        _atomic_torch_save(state, save_path)
+    return save_path
@@ -0,0 +1,147 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.distributed as dist
+
+from lailib.torch.tensor_file import TensorFile, flatten_state, save_tensors, unflatten_state, _DTYPES, \
+    _NAME_TO_DTYPE
+from lailib.profiling import instrument, state_nbytes
+
+SHARD_EXTENSION = '.shards'
+MANIFEST_NAME = 'manifest.json'
+
+
+def _rank_and_world_size(group):
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(group), dist.get_world_size(group)
+    return 0, 1
+
+
+def _assign_shards(tensors, num_shards):
+    '''
+    balance tensors over shards by size, every rank computes the same assignment
+    :param tensors: dict of name -> tensor
+    :param num_shards: number of shards
+    :return: dict of name -> shard index
+    '''
+    loads = [0] * num_shards
+    assignment = {}
+    for name in sorted(tensors, key=lambda name: (-tensors[name].numel() * tensors[name].element_size(), name)):
+        shard = loads.index(min(loads))
+        assignment[name] = shard
+        loads[shard] += tensors[name].numel() * tensors[name].element_size()
+    return assignment
+
+
+def _shard_name(shard, num_shards):
+    return 'shard-%05d-of-%05d.tensors' % (shard, num_shards)
+
+
+def sharded_checkpoint_dir(save_dir, model_name, global_step):
+    return os.path.join(str(save_dir), '%s_%s%s' % (model_name, global_step, SHARD_EXTENSION))
+
+
+@instrument(nbytes=state_nbytes)
+def save_sharded(network, optimizer, save_dir, model_name, global_step, group=None):
+    '''
+    data parallel checkpoint save, every torch.distributed rank writes a disjoint,
+    size balanced slice of the (identical) network and optimizer state in parallel,
+    rank 0 then writes the global manifest. Without an initialized process group the
+    whole state goes to a single shard. Must be called by every rank of the group.
+    :param network: the pytorch neural network that should be saved
+    :param optimizer: the optimizer for network training
+    :param save_dir: path to the checkpoint directory
+    :param model_name: name of the model
+    :param global_step: step of the checkpoint
+    :param group: optional torch.distributed process group
+    :return: checkpoint directory <save_dir>/<model_name>_<global_step>.shards
+    '''
+    if '_' in model_name or '.' in model_name:
+        raise ValueError('model name can not contain "." or "_"')
+    rank, world_size = _rank_and_world_size(group)
+    checkpoint_dir = sharded_checkpoint_dir(save_dir, model_name, global_step)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    tensors, skeleton = flatten_state({'state_dict': network.state_dict(), 'optimizer': optimizer.state_dict()})
+    assignment = _assign_shards(tensors, world_size)
+    own = dict((name, tensor) for name, tensor in tensors.items() if assignment[name] == rank)
+    save_tensors(own, os.path.join(checkpoint_dir, _shard_name(rank, world_size)))
+    if world_size > 1:
+        dist.barrier(group)
+    if rank == 0:
+        manifest = {'world_size': world_size,
+                    'shards': [_shard_name(shard, world_size) for shard in range(world_size)],
+                    'tensors': dict((name, {'shard': assignment[name],
+                                            'dtype': _DTYPES[tensor.dtype][0],
+                                            'shape': list(tensor.shape)})
+                                    for name, tensor in tensors.items()),
+                    'state': skeleton}
+        tmp_path = os.path.join(checkpoint_dir, MANIFEST_NAME + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, os.path.join(checkpoint_dir, MANIFEST_NAME))
+    if world_size > 1:
+        # nobody returns before the checkpoint is complete
+        dist.barrier(group)
+    return checkpoint_dir
+
+
+class _ShardedSource(object):
+    '''
+    tensor lookup for unflatten_state over the tensors read from the shards
+    '''
+    def __init__(self, tensors):
+        self.tensors = tensors
+
+    def get(self, name, copy=False):
+        return self.tensors[name]
+
+
+@instrument
+def load_sharded_state(save_dir, model_name, global_step, keys=None, group=None, broadcast=False, workers=None):
+    '''
+    read a save_sharded checkpoint, the world size may differ from the one used for saving.
+    By default every process reads all shards with a thread pool. With broadcast=True each
+    rank reads only every world_size-th shard and the tensors are broadcast to the other
+    ranks, so the file system is read once in total.
+    :param save_dir: where the checkpoint sits
+    :param model_name: name of the model
+    :param global_step: step of the checkpoint
+    :param keys: optional list of top level keys, e.g. ['state_dict']
+    :param group: optional torch.distributed process group
+    :param broadcast: read disjoint shards per rank and broadcast them, needs an initialized process group
+    :param workers: threads reading shards in parallel
+    :return: dict with 'state_dict' and 'optimizer'
+    '''
+    checkpoint_dir = sharded_checkpoint_dir(save_dir, model_name, global_step)
+    with open(os.path.join(checkpoint_dir, MANIFEST_NAME), 'r') as f:
+        manifest = json.load(f)
+    entries = manifest['tensors']
+    if keys is not None:
+        entries = dict((name, entry) for name, entry in entries.items() if name.split('.')[0] in keys)
+    rank, world_size = _rank_and_world_size(group)
+    use_broadcast = broadcast and world_size > 1
+    shards = sorted(set(entry['shard'] for entry in entries.values()))
+    if use_broadcast:
+        shards = [shard for shard in shards if shard % world_size == rank]
+
+    def read(shard):
+        tensor_file = TensorFile(os.path.join(checkpoint_dir, manifest['shards'][shard]))
+        return dict((name, tensor_file.get(name, copy=True)) for name, entry in entries.items()
+                    if entry['shard'] == shard)
+
+    tensors = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for shard_tensors in pool.map(read, shards):
+            tensors.update(shard_tensors)
+
+    if use_broadcast:
+        for name in sorted(entries):
+            entry = entries[name]
+            owner = entry['shard'] % world_size
+            if owner != rank:
+                tensors[name] = torch.empty(entry['shape'], dtype=_NAME_TO_DTYPE[entry['dtype']][0])
+            dist.broadcast(tensors[name], src=dist.get_global_rank(group, owner) if group is not None else owner,
+                           group=group)
+    return unflatten_state(manifest['state'], _ShardedSource(tensors), keys)
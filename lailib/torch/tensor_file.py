@@ -0,0 +1,356 @@
+import bz2
+import json
+import lzma
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from lailib.profiling import instrument, path_nbytes
+
+# file layout:
+#   8 bytes magic | 8 bytes little endian header size | json header | tensor data
+# every tensor starts at a multiple of ALIGNMENT bytes from the file start, so it can be
+# viewed in place from a memory map
+MAGIC = b'LAITNSR1'
+ALIGNMENT = 64
+
+# torch dtype -> (name in the header, numpy dtype with the same memory layout)
+_DTYPES = {
+    torch.float64: ('float64', np.float64),
+    torch.float32: ('float32', np.float32),
+    torch.float16: ('float16', np.float16),
+    torch.bfloat16: ('bfloat16', np.int16),
+    torch.int64: ('int64', np.int64),
+    torch.int32: ('int32', np.int32),
+    torch.int16: ('int16', np.int16),
+    torch.int8: ('int8', np.int8),
+    torch.uint8: ('uint8', np.uint8),
+    torch.bool: ('bool', np.bool_),
+}
+_NAME_TO_DTYPE = dict((name, (torch_dtype, np_dtype)) for torch_dtype, (name, np_dtype) in _DTYPES.items())
+
+# codec name -> (compress, decompress), stdlib only
+CODECS = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'bz2': (bz2.compress, bz2.decompress),
+    'lzma': (lambda data, preset=None: lzma.compress(data, preset=preset), lzma.decompress),
+}
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _tensor_bytes(tensor):
+    '''
+    :param tensor: cpu or cuda tensor
+    :return: numpy array sharing the tensor memory (after moving it to cpu)
+    '''
+    if tensor.dtype not in _DTYPES:
+        raise TypeError('tensor dtype {} is not supported by the tensor file format'.format(tensor.dtype))
+    tensor = tensor.detach().cpu().contiguous()
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.view(torch.int16)
+    return tensor.numpy()
+
+
+def _encode(tensor, storage_dtype, codec, level):
+    '''
+    :param tensor: tensor to store
+    :param storage_dtype: optional torch dtype floating tensors are downcast to
+    :param codec: optional codec name in CODECS
+    :param level: compression level, None for the codec default
+    :return: header entry (without offset), bytes like object to write
+    '''
+    entry = {}
+    if storage_dtype is not None and tensor.is_floating_point() \
+            and tensor.element_size() > torch.empty(0, dtype=storage_dtype).element_size():
+        entry['orig_dtype'] = _DTYPES[tensor.dtype][0]
+        tensor = tensor.to(storage_dtype)
+    array = _tensor_bytes(tensor)
+    entry.update({'dtype': _DTYPES[tensor.dtype][0],
+                  'shape': list(tensor.shape),
+                  'nbytes': array.nbytes})
+    data = array.reshape(-1).view(np.uint8).data
+    if codec is not None:
+        compress = CODECS[codec][0]
+        data = compress(data) if level is None else compress(data, level)
+        entry['codec'] = codec
+        entry['stored_nbytes'] = len(data)
+    return entry, data
+
+
+@instrument(nbytes=path_nbytes)
+def save_tensors(tensors, path, metadata=None, storage_dtype=None, downcast_prefix=None,
+                 codec=None, level=None, workers=None):
+    '''
+    save a flat dict of tensors without pickle, the file is written to a temp file
+    and renamed, so readers never see a partial file
+    :param tensors: dict of name -> tensor
+    :param path: output file path
+    :param metadata: optional json serializable object stored in the header
+    :param storage_dtype: optional torch.float16 or torch.bfloat16, wider floating tensors are
+                          downcast on disk and upcast again by TensorFile.get
+    :param downcast_prefix: optional name prefix (or tuple of prefixes) limiting which tensors are downcast
+    :param codec: optional per tensor compression, one of CODECS ('zlib', 'bz2', 'lzma'),
+                  compressed tensors are decompressed on read instead of being memory mapped
+    :param level: compression level, None for the codec default
+    :param workers: threads used to downcast and compress tensors in parallel
+    :return: None
+    '''
+    if storage_dtype not in (None, torch.float16, torch.bfloat16):
+        raise ValueError('storage_dtype must be None, torch.float16 or torch.bfloat16')
+    if codec is not None and codec not in CODECS:
+        raise ValueError('codec must be None or one of {}'.format(sorted(CODECS)))
+    for tensor in tensors.values():
+        if tensor.dtype not in _DTYPES:
+            raise TypeError('tensor dtype {} is not supported by the tensor file format'.format(tensor.dtype))
+
+    def encode(item):
+        name, tensor = item
+        downcast = downcast_prefix is None or name.startswith(downcast_prefix)
+        return _encode(tensor, storage_dtype if downcast else None, codec, level)
+
+    items = list(tensors.items())
+    if (storage_dtype is not None or codec is not None) and len(items) > 1 and workers != 1:
+        # zlib, bz2 and lzma release the GIL while compressing
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            encoded = list(pool.map(encode, items))
+    else:
+        encoded = [encode(item) for item in items]
+
+    entries = {}
+    offset = 0
+    for (name, _), (entry, data) in zip(items, encoded):
+        entry['offset'] = offset
+        entries[name] = entry
+        offset = _align(offset + entry.get('stored_nbytes', entry['nbytes']))
+    options = {'storage_dtype': None if storage_dtype is None else _DTYPES[storage_dtype][0],
+               'downcast_prefix': downcast_prefix,
+               'codec': codec}
+    header = json.dumps({'tensors': entries, 'metadata': metadata, 'options': options}).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            for (name, _), (_, data) in zip(items, encoded):
+                f.seek(data_start + entries[name]['offset'])
+                f.write(data)
+            f.truncate(data_start + offset)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class TensorFile(object):
+    '''
+    lazy reader of a save_tensors file. The file is memory mapped and tensors are
+    created on request as views of the mapped pages, so only the touched tensors
+    are read from disk and nothing is unpickled.
+
+    usage:
+        with TensorFile(path) as f:
+            encoder = f.load(prefix='encoder.')
+    '''
+    def __init__(self, path):
+        '''
+        :param path: file written by save_tensors
+        '''
+        self.path = str(path)
+        with open(self.path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{} is not a tensor file'.format(self.path))
+            header_size = struct.unpack('<Q', f.read(8))[0]
+            header = json.loads(f.read(header_size).decode('utf-8'))
+        self.entries = header['tensors']
+        self.metadata = header['metadata']
+        # files written before storage options existed have no options entry
+        self.options = header.get('options', {'storage_dtype': None, 'downcast_prefix': None, 'codec': None})
+        self._data_start = _align(len(MAGIC) + 8 + header_size)
+        self._mmap = None
+
+    def _open(self):
+        if self._mmap is None:
+            with open(self.path, 'rb') as f:
+                # copy on write, so tensors are writable without touching the file
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        return self._mmap
+
+    def keys(self):
+        return list(self.entries.keys())
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def raw(self, name):
+        '''
+        :param name: tensor name
+        :return: the stored (possibly downcast) bytes of a tensor as 1d uint8 numpy array,
+                 a view of the file unless the tensor is compressed
+        '''
+        entry = self.entries[name]
+        codec = entry.get('codec')
+        if codec is None:
+            return np.frombuffer(self._open(), dtype=np.uint8, count=entry['nbytes'],
+                                 offset=self._data_start + entry['offset'])
+        start = self._data_start + entry['offset']
+        data = CODECS[codec][1](self._open()[start:start + entry['stored_nbytes']])
+        return np.frombuffer(bytearray(data), dtype=np.uint8)
+
+    def get(self, name, copy=False):
+        '''
+        :param name: tensor name
+        :param copy: if set to true, return a tensor that owns its memory instead of a view of the file
+                     (compressed and downcast tensors always own their memory)
+        :return: cpu tensor
+        '''
+        entry = self.entries[name]
+        torch_dtype, np_dtype = _NAME_TO_DTYPE[entry['dtype']]
+        array = self.raw(name).view(np_dtype).reshape(entry['shape'])
+        if copy and entry.get('codec') is None:
+            array = array.copy()
+        tensor = torch.from_numpy(array)
+        if torch_dtype == torch.bfloat16:
+            tensor = tensor.view(torch.bfloat16)
+        if 'orig_dtype' in entry:
+            tensor = tensor.to(_NAME_TO_DTYPE[entry['orig_dtype']][0])
+        return tensor
+
+    def load(self, names=None, prefix=None, copy=False):
+        '''
+        read a subset of the tensors
+        :param names: optional list of tensor names
+        :param prefix: optional name prefix, e.g. 'encoder.'
+        :param copy: see get
+        :return: dict of name -> tensor
+        '''
+        keys = self.keys() if names is None else list(names)
+        if prefix is not None:
+            keys = [key for key in keys if key.startswith(prefix)]
+        return dict((key, self.get(key, copy=copy)) for key in keys)
+
+    def close(self):
+        # views handed out keep the mapping alive until they are released
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _flatten(obj, prefix, tensors):
+    '''
+    split a nested state dict into a flat dict of tensors and a json skeleton
+    :param obj: state dict or a value inside it
+    :param prefix: name of obj in the flat dict
+    :param tensors: flat dict filled with the found tensors
+    :return: json serializable skeleton, tensors are replaced by {'__tensor__': name}
+    '''
+    if torch.is_tensor(obj):
+        tensors[prefix] = obj
+        return {'__tensor__': prefix}
+    if isinstance(obj, dict):
+        if all(isinstance(k, str) for k in obj):
+            return {'__dict__': dict((k, _flatten(v, prefix + '.' + k, tensors)) for k, v in obj.items())}
+        # optimizer states use integer keys, keep them as key value pairs
+        return {'__items__': [[k, _flatten(v, '{}.{}'.format(prefix, k), tensors)] for k, v in obj.items()]}
+    if isinstance(obj, (list, tuple)):
+        values = [_flatten(v, '{}.{}'.format(prefix, i), tensors) for i, v in enumerate(obj)]
+        return {'__tuple__': values} if isinstance(obj, tuple) else values
+    return obj
+
+
+def _unflatten(skeleton, tensor_file, copy=False):
+    '''
+    inverse of _flatten
+    :param skeleton: json skeleton
+    :param tensor_file: TensorFile holding the tensors
+    :param copy: see TensorFile.get
+    :return: nested state dict
+    '''
+    if isinstance(skeleton, dict):
+        if '__tensor__' in skeleton:
+            return tensor_file.get(skeleton['__tensor__'], copy=copy)
+        if '__dict__' in skeleton:
+            return dict((k, _unflatten(v, tensor_file, copy)) for k, v in skeleton['__dict__'].items())
+        if '__items__' in skeleton:
+            return dict((k, _unflatten(v, tensor_file, copy)) for k, v in skeleton['__items__'])
+        if '__tuple__' in skeleton:
+            return tuple(_unflatten(v, tensor_file, copy) for v in skeleton['__tuple__'])
+    if isinstance(skeleton, list):
+        return [_unflatten(v, tensor_file, copy) for v in skeleton]
+    return skeleton
+
+
+def flatten_state(state):
+    '''
+    :param state: dict of str -> state dict
+    :return: flat dict of name -> tensor, json skeleton of the state
+    '''
+    tensors = {}
+    skeleton = dict((key, _flatten(value, key, tensors)) for key, value in state.items())
+    return tensors, skeleton
+
+
+@instrument(nbytes=path_nbytes)
+def save_state(state, path, metadata=None, **storage_options):
+    '''
+    save a nested state (e.g. {'state_dict': ..., 'optimizer': ...}) in the tensor file format
+    :param state: dict of str -> state dict
+    :param path: output file path
+    :param metadata: optional dict of extra json serializable header entries
+    :param storage_options: storage_dtype, downcast_prefix, codec, level, workers, see save_tensors
+    :return: None
+    '''
+    tensors, skeleton = flatten_state(state)
+    header = dict(metadata or {})
+    header['state'] = skeleton
+    save_tensors(tensors, path, metadata=header, **storage_options)
+
+
+@instrument
+def load_state(path, keys=None, copy=False):
+    '''
+    load the parts of a save_state file, tensors of unrequested parts are never read
+    :param path: file written by save_state
+    :param keys: optional list of top level keys to load, e.g. ['state_dict']
+    :param copy: see TensorFile.get
+    :return: dict of key -> state dict
+    '''
+    tensor_file = TensorFile(path)
+    return unflatten_state(tensor_file.metadata['state'], tensor_file, keys, copy)
+
+
+def unflatten_state(skeleton, tensor_source, keys=None, copy=False):
+    '''
+    :param skeleton: json skeleton from flatten_state
+    :param tensor_source: object with a get(name, copy) method returning tensors, e.g. TensorFile
+    :param keys: optional list of top level keys to rebuild
+    :param copy: passed to tensor_source.get
+    :return: dict of key -> state dict
+    '''
+    keys = skeleton.keys() if keys is None else keys
+    return dict((key, _unflatten(skeleton[key], tensor_source, copy)) for key in keys)
+
+
+def load_options(path):
+    '''
+    :param path: file written by save_tensors
+    :return: dict of the storage options (storage_dtype, downcast_prefix, codec) the file was saved with
+    '''
+    return TensorFile(path).options
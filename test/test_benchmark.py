@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from lailib.benchmark import peak_memory, measure, compare, run_benchmarks, save_results, load_results, main
+
+
+def test_measure_statistics():
+    stats = measure(lambda: np.ones(1 << 20, dtype=np.uint8), repeat=5, warmup=1, items=2, nbytes=1 << 20)
+    assert stats['repeat'] == 5
+    assert stats['min_ms'] <= stats['p50_ms'] <= stats['p90_ms'] <= stats['p99_ms']
+    assert stats['items_per_s'] > 0 and stats['mb_per_s'] > 0
+    assert stats['peak_mb'] >= 1
+
+
+def test_peak_memory_sees_torch():
+    torch = pytest.importorskip('torch')
+    # 40 MB from the torch allocator, invisible to tracemalloc
+    assert peak_memory(lambda: torch.ones(10 ** 7) + 1) >= 40 * 2 ** 20
+
+
+def test_compare_thresholds():
+    baseline = {'results': {'a': {'p50_ms': 1.0}, 'b': {'p50_ms': 2.0}, 'gone': {'p50_ms': 1.0}}}
+    current = {'results': {'a': {'p50_ms': 1.1}, 'b': {'p50_ms': 3.0}, 'new': {'p50_ms': 5.0}}}
+    regressions = compare(current, baseline, threshold=0.2)
+    assert [r['case'] for r in regressions] == ['b']
+    assert regressions[0]['ratio'] == 1.5
+    assert compare(current, baseline, threshold=0.2, thresholds={'b': 0.6}) == []
+    assert [r['case'] for r in compare(current, baseline, threshold=0.05)] == ['a', 'b']
+
+
+def test_compare_throughput_direction():
+    baseline = {'results': {'slower': {'mb_per_s': 100.}, 'faster': {'mb_per_s': 100.}}}
+    current = {'results': {'slower': {'mb_per_s': 50.}, 'faster': {'mb_per_s': 200.}}}
+    regressions = compare(current, baseline, threshold=0.2, metric='mb_per_s')
+    assert [r['case'] for r in regressions] == ['slower']
+    assert regressions[0]['ratio'] == 2.
+    with pytest.raises(ValueError, match='metric must be one of'):
+        compare(current, baseline, metric='repeat')
+
+
+def test_run_quick_suite(tmpdir):
+    results = run_benchmarks(['crop_boundary_and_padding', 'load_network/tensors'], ['line', 'tiny'], repeat=2,
+                             warmup=0)
+    assert sorted(results['results']) == ['crop_boundary_and_padding/line', 'load_network/tensors/tiny']
+    assert 'numpy' in results['environment']
+    path = str(tmpdir.join('baseline.json'))
+    save_results(results, path)
+    assert load_results(path)['results'].keys() == results['results'].keys()
+
+
+def test_main_exit_code(tmpdir, monkeypatch):
+    monkeypatch.setenv('CUDA_VISIBLE_DEVICES', '')
+    path = str(tmpdir.join('baseline.json'))
+    assert main(['--filter', 'otsu_thresh', '--sizes', 'line', '--repeat', '2', '--save-baseline', path]) == 0
+    baseline = load_results(path)
+    baseline['results']['otsu_thresh/line']['p50_ms'] = 1e-9
+    save_results(baseline, path)
+    assert main(['--filter', 'otsu_thresh', '--sizes', 'line', '--repeat', '2', '--baseline', path]) == 1
@@ -0,0 +1,109 @@
+import cv2
+import numpy as np
+import pytest
+from lailib.image.binarize import otsu_thresh, otsu_thresh_batch, intensity_histograms, tiled_thresh, \
+    _otsu_from_histograms
+
+
+def uneven_page(height=90, width=130, seed=0):
+    rng = np.random.RandomState(seed)
+    background = np.linspace(20, 160, width)[None, :] + np.zeros((height, 1))
+    im = background + rng.randint(0, 10, size=(height, width))
+    im[10:20, 5:120] += 80
+    im[50:60, 30:90] += 80
+    return np.clip(im, 0, 255).astype(np.uint8)
+
+
+def naive_local_thresh(im, window_size, method, k, r=128):
+    half = window_size // 2
+    out = np.zeros_like(im)
+    for y in range(im.shape[0]):
+        for x in range(im.shape[1]):
+            window = im[max(y - half, 0):y + half + 1, max(x - half, 0):x + half + 1].astype(np.float64)
+            mean, std = window.mean(), window.std()
+            thresh = mean * (1 + k * (std / r - 1)) if method == 'sauvola' else mean + k * std
+            out[y, x] = 255 if im[y, x] > thresh else 0
+    return out
+
+
+def test_otsu_from_histograms_matches_cv2():
+    rng = np.random.RandomState(1)
+    ims = [rng.randint(0, 256, size=(20, 30)).astype(np.uint8), uneven_page()]
+    hists = np.stack([np.bincount(im.ravel(), minlength=256) for im in ims])
+    for im, thresh in zip(ims, _otsu_from_histograms(hists)):
+        cv2_thresh, _ = cv2.threshold(im, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        assert thresh == cv2_thresh
+
+
+def test_tiled_otsu():
+    im = uneven_page()
+    assert np.array_equal(tiled_thresh(im, tile_size=1024), otsu_thresh(im))
+    tiled = tiled_thresh(im, tile_size=(45, 65), workers=4)
+    for row in (0, 45):
+        for col in (0, 65):
+            assert np.array_equal(tiled[row:row + 45, col:col + 65], otsu_thresh(im[row:row + 45, col:col + 65]))
+
+
+def test_tiled_otsu_min_contrast():
+    im = np.full((40, 40), 100, dtype=np.uint8)
+    im[:20, :20] = 101
+    im[30:35, 30:35] = 200
+    res = tiled_thresh(im, tile_size=20, min_contrast=50)
+    assert res[:30, :30].sum() == 0
+    assert res[30:35, 30:35].all()
+
+
+@pytest.mark.parametrize('method,k', [('sauvola', 0.2), ('niblack', -0.2)])
+def test_local_methods_match_naive_and_tiling(method, k):
+    im = uneven_page(40, 50)
+    expected = naive_local_thresh(im, 7, method, k)
+    assert np.array_equal(tiled_thresh(im, tile_size=1024, method=method, window_size=7), expected)
+    assert np.array_equal(tiled_thresh(im, tile_size=(9, 13), method=method, window_size=7, workers=3), expected)
+
+
+def test_memmap(tmpdir):
+    im = uneven_page()
+    src = np.lib.format.open_memmap(str(tmpdir.join('in.npy')), mode='w+', dtype=np.uint8, shape=im.shape)
+    src[:] = im
+    dst = np.lib.format.open_memmap(str(tmpdir.join('out.npy')), mode='w+', dtype=np.uint8, shape=im.shape)
+    res = tiled_thresh(src, tile_size=32, method='sauvola', out=dst)
+    assert res is dst
+    assert np.array_equal(dst, tiled_thresh(im, method='sauvola'))
+
+
+def test_wrong_input():
+    with pytest.raises(TypeError, match='input image must be gray scale image as uint8 ndarray'):
+        tiled_thresh(np.ones((3, 3)))
+    with pytest.raises(ValueError, match='method must be'):
+        tiled_thresh(np.ones((3, 3), dtype=np.uint8), method='bernsen')
+    with pytest.raises(ValueError, match='window_size must be a positive odd integer'):
+        tiled_thresh(np.ones((3, 3), dtype=np.uint8), method='sauvola', window_size=4)
+
+
+def test_otsu_thresh_batch_stack_and_list():
+    rng = np.random.RandomState(2)
+    stack = rng.randint(0, 256, size=(5, 12, 17)).astype(np.uint8)
+    stack[0] = 0
+    binarized, thresholds, hists = otsu_thresh_batch(stack)
+    assert binarized.dtype == np.uint8 and binarized.shape == stack.shape
+    for i, im in enumerate(stack):
+        assert np.array_equal(binarized[i], otsu_thresh(im))
+        assert np.array_equal(hists[i], np.bincount(im.ravel(), minlength=256))
+
+    ims = [uneven_page(), uneven_page(20, 7, seed=3), stack[1]]
+    binarized, thresholds, hists = otsu_thresh_batch(ims)
+    for im, res in zip(ims, binarized):
+        assert np.array_equal(res, otsu_thresh(im))
+    reused, reused_thresholds, _ = otsu_thresh_batch(ims, hists=hists)
+    assert np.array_equal(reused_thresholds, thresholds)
+
+
+def test_intensity_histograms_wrong_input():
+    with pytest.raises(TypeError, match=r'input image stack must be \(N, H, W\) uint8 ndarray'):
+        intensity_histograms(np.ones((2, 3, 3)))
+    with pytest.raises(TypeError, match='input image must be gray scale image as uint8 ndarray'):
+        intensity_histograms([np.ones((3, 3))])
+    assert intensity_histograms([]).shape == (0, 256)
+    assert intensity_histograms(np.zeros((0, 4, 5), dtype=np.uint8)).shape == (0, 256)
+    binarized, thresholds, hists = otsu_thresh_batch(np.zeros((0, 4, 5), dtype=np.uint8))
+    assert binarized.shape == (0, 4, 5) and thresholds.shape == (0,) and hists.shape == (0, 256)
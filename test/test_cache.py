@@ -0,0 +1,75 @@
+import os
+import numpy as np
+from lailib.image.cache import PreprocessCache
+from lailib.image.pipeline import PreprocessPipeline
+
+
+def test_get_put(tmpdir):
+    cache = PreprocessCache(tmpdir)
+    src = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    key = cache.make_key(src, padding=2, height=32)
+    assert key == cache.make_key(src.copy(), height=32, padding=2)
+    assert key != cache.make_key(src, padding=3, height=32)
+    assert key != cache.make_key(src.T, padding=2, height=32)
+    assert cache.get(key) is None
+    cache.put(key, src * 2)
+    res = cache.get(key)
+    assert isinstance(res, np.memmap)
+    assert np.array_equal(res, src * 2)
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['hit_rate'], stats['bytes_saved']) == (1, 1, 0.5, 12)
+
+
+def test_get_or_compute_path(tmpdir):
+    path = str(tmpdir.join('src.bin'))
+    with open(path, 'wb') as f:
+        f.write(b'abc')
+    cache = PreprocessCache(tmpdir.join('cache'))
+    calls = []
+
+    def compute(source):
+        calls.append(source)
+        return np.ones((2, 2), dtype=np.uint8)
+
+    for _ in range(3):
+        assert cache.get_or_compute(path, compute, mode='otsu').sum() == 4
+    assert calls == [path]
+    assert cache.make_key(path) == cache.make_key(b'abc')
+
+
+def test_lru_eviction(tmpdir):
+    cache = PreprocessCache(tmpdir, max_bytes=3000, evict_ratio=0.7)
+    arr = np.zeros(800, dtype=np.uint8)
+    for i in range(3):
+        cache.put('key%d' % i, arr)
+        os.utime(cache._path('key%d' % i), (i, i))
+    cache.get('key0')
+    cache.put('key3', arr)
+    remaining = [key for key in ['key0', 'key1', 'key2', 'key3'] if os.path.exists(cache._path(key))]
+    assert remaining == ['key0', 'key3']
+    assert cache.size() <= 2100
+
+
+def test_pipeline_cache(tmpdir):
+    im = np.zeros((10, 10), dtype=np.uint8)
+    im[2:5, 3:6] = 255
+    cache = PreprocessCache(tmpdir)
+    pipeline = PreprocessPipeline(padding=1, workers=2, cache=cache)
+    first = [res.image for res in pipeline.run([im, im])]
+    second = [res.image for res in pipeline.run([im])]
+    assert np.array_equal(first[0], second[0]) and second[0].shape == (5, 5)
+    assert cache.stats()['hits'] >= 1
+
+
+def test_process_pipeline_cache(tmpdir):
+    ims = [np.zeros((40, 40 + i), dtype=np.uint8) for i in range(40)]
+    for i, im in enumerate(ims):
+        im[5:35, 5:35 + i] = 255
+    cache = PreprocessCache(tmpdir, max_bytes=20000)
+    pipeline = PreprocessPipeline(padding=1, binarize='vanilla', workers=2, executor='process', cache=cache)
+    assert len(list(pipeline.run(ims))) == 40
+    assert cache.size() <= 20000
+    list(pipeline.run(ims[-2:]))
+    stats = cache.stats()
+    assert stats['misses'] == 40 and stats['hits'] == 2
+    assert stats['bytes_written'] > 20000
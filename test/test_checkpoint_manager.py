@@ -0,0 +1,98 @@
+import json
+import os
+import torch
+import torch.nn as nn
+import pytest
+from lailib.torch.checkpoint_manager import CheckpointManager
+from lailib.torch.parameter_store import save_network, load_last_checkpoint
+
+
+class DummyTorchModule(nn.Module):
+    def __init__(self):
+        super(DummyTorchModule, self).__init__()
+        self.test_weight = torch.nn.Parameter(torch.randn(5, 5))
+
+
+def make_model():
+    model = DummyTorchModule()
+    return model, torch.optim.Adagrad(model.parameters(), lr=5e-4)
+
+
+def pth_files(tmpdir, model_name='Dummy'):
+    return sorted(f for f in os.listdir(str(tmpdir)) if f.startswith(model_name + '_'))
+
+
+def test_latest_and_best(tmpdir):
+    manager = CheckpointManager(tmpdir, 'Dummy', background=False)
+    assert manager.latest_step() is None
+    models = {}
+    for step, metric in [(10, 3.), (20, 1.), (30, 2.)]:
+        model, optimizer = make_model()
+        models[step] = model
+        manager.save(model, optimizer, step, metric=metric, use_gpu=False)
+    assert manager.latest_step() == 30 and manager.best_step() == 20
+
+    reopened = CheckpointManager(tmpdir, 'Dummy')
+    assert reopened.latest_step() == 30 and reopened.best_step() == 20
+    model, optimizer = make_model()
+    model, optimizer, step = reopened.load_best(model, optimizer, use_gpu=False)
+    assert step == 20 and torch.equal(model.test_weight, models[20].test_weight)
+    model, optimizer, step = reopened.load_latest(model, optimizer, use_gpu=False)
+    assert step == 30 and torch.equal(model.test_weight, models[30].test_weight)
+    with open(reopened.manifest_path) as f:
+        assert json.load(f)['latest'] == 30
+
+
+def test_retention(tmpdir):
+    manager = CheckpointManager(tmpdir, 'Dummy', keep_last=2, keep_every=40)
+    model, optimizer = make_model()
+    for step in range(10, 110, 10):
+        manager.save(model, optimizer, step, metric=1. if step == 30 else 5., use_gpu=False)
+    manager.wait()
+    assert pth_files(tmpdir) == ['Dummy_100.pth', 'Dummy_30.pth', 'Dummy_40.pth', 'Dummy_80.pth', 'Dummy_90.pth']
+    assert [c['global_step'] for c in manager.manifest['checkpoints']] == [30, 40, 80, 90, 100]
+    manager.close()
+
+
+def test_retention_keep_every_only(tmpdir):
+    manager = CheckpointManager(tmpdir, 'Dummy', keep_every=10, background=False)
+    model, optimizer = make_model()
+    for step in range(1, 26):
+        manager.save(model, optimizer, step, metric=0. if step == 7 else 1., use_gpu=False)
+    assert pth_files(tmpdir) == ['Dummy_10.pth', 'Dummy_20.pth', 'Dummy_25.pth', 'Dummy_7.pth']
+    assert [c['global_step'] for c in manager.manifest['checkpoints']] == [7, 10, 20, 25]
+
+
+def test_best_overwritten_with_worse_metric(tmpdir):
+    manager = CheckpointManager(tmpdir, 'Dummy', background=False)
+    model, optimizer = make_model()
+    manager.save(model, optimizer, 1, metric=0.5, use_gpu=False)
+    manager.save(model, optimizer, 2, metric=0.1, use_gpu=False)
+    assert manager.best_step() == 2
+    manager.save(model, optimizer, 2, metric=0.9, use_gpu=False)
+    assert manager.manifest['best'] == {'global_step': 1, 'metric': 0.5}
+    manager.save(model, optimizer, 1, metric=None, use_gpu=False)
+    assert manager.manifest['best'] == {'global_step': 2, 'metric': 0.9}
+    manager.save(model, optimizer, 2, metric=0.05, use_gpu=False)
+    assert manager.manifest['best'] == {'global_step': 2, 'metric': 0.05}
+
+
+def test_models_share_directory(tmpdir):
+    model, optimizer = make_model()
+    save_network(model, optimizer, tmpdir, 'Other', 500, use_gpu=False)
+    manager = CheckpointManager(tmpdir, 'Dummy', background=False)
+    assert manager.latest_step() is None
+    save_network(model, optimizer, tmpdir, 'Dummy', 7, use_gpu=False)
+    assert CheckpointManager(tmpdir, 'Dummy').latest_step() == 7
+    _, _, step = load_last_checkpoint(model, optimizer, tmpdir, 'Dummy', use_gpu=False)
+    assert step == 7
+
+
+def test_invalid_args(tmpdir):
+    with pytest.raises(ValueError, match='model name can not contain "." or "_"'):
+        CheckpointManager(tmpdir, 'dummy_model')
+    with pytest.raises(ValueError, match='metric_mode must be'):
+        CheckpointManager(tmpdir, 'Dummy', metric_mode='avg')
+    model, optimizer = make_model()
+    with pytest.raises(ValueError, match='no checkpoint of model Dummy has a metric'):
+        CheckpointManager(tmpdir, 'Dummy').load_best(model, optimizer, use_gpu=False)
@@ -1,6 +1,7 @@
 import pytest
 import numpy as np
-from lailib.image.crop import crop_boundary_and_padding
+from lailib.image.crop import crop_boundary_and_padding, crop_boundary_and_padding_batch, crop_boxes_batch, \
+    crop_regions_and_padding, region_boxes, crop_boundary_and_padding_chunked
 
 class TestCropBoundaryAndPad:
     @staticmethod
@@ -113,3 +114,201 @@ class TestCropBoundaryAndPad:
             crop_boundary_and_padding(in_im, binarized=small_mask)
         with pytest.raises(TypeError, match='binarized mask must be uint8 ndarray'):
             crop_boundary_and_padding(in_im, binarized=wrong_type)
+
+
+class TestCropBoundaryAndPadBatch:
+    @staticmethod
+    def stack_case():
+        ims = np.zeros((3, 10, 12), dtype=np.uint8)
+        ims[0, 2:4, 3:7] = 255
+        ims[1, 0, 0] = 255
+        ims[1, 9, 11] = 255
+        ims[2, 5, 5] = 128
+        return ims
+
+    def test_padded_matches_single(self):
+        ims = self.stack_case()
+        out, shapes = crop_boundary_and_padding_batch(ims, padding=[1, 2, 3, 4])
+        assert out.dtype == np.uint8
+        assert out.shape == (3,) + tuple(shapes.max(axis=0))
+        for i, im in enumerate(ims):
+            single = crop_boundary_and_padding(im, padding=[1, 2, 3, 4])
+            h, w = shapes[i]
+            assert np.array_equal(out[i, :h, :w], single)
+            assert not out[i, h:].any() and not out[i, :, w:].any()
+
+    def test_packed_list(self):
+        ims = [np.pad(np.ones((2, 3), dtype=np.uint8) * 255, ((1, 4), (5, 0))),
+               np.pad(np.ones((4, 1), dtype=np.uint8) * 255, ((0, 2), (3, 3)))]
+        buffer, offsets, shapes = crop_boundary_and_padding_batch(ims, padding=2, layout='packed')
+        assert offsets[-1] == buffer.size
+        for i, im in enumerate(ims):
+            single = crop_boundary_and_padding(im, padding=2)
+            assert np.array_equal(buffer[offsets[i]:offsets[i + 1]].reshape(shapes[i]), single)
+
+    def test_with_binarized(self):
+        ims = self.stack_case()
+        masks = (ims > 0).astype(np.uint8)
+        boxes = crop_boxes_batch(ims, binarized=masks)
+        assert boxes.tolist() == [[2, 4, 3, 7], [0, 10, 0, 12], [5, 6, 5, 6]]
+
+    def test_all_zero_im(self):
+        ims = self.stack_case()
+        ims[1] = 0
+        with pytest.raises(ValueError, match='In image for crop function is all zero'):
+            crop_boundary_and_padding_batch(ims)
+        with pytest.raises(ValueError, match='In image for crop function is all zero'):
+            crop_boundary_and_padding_batch(list(ims))
+
+    def test_wrong_input(self):
+        with pytest.raises(TypeError, match=r'input image stack must be \(N, H, W\) uint8 ndarray'):
+            crop_boundary_and_padding_batch(np.ones((2, 3, 3)))
+        with pytest.raises(ValueError, match='layout must be'):
+            crop_boundary_and_padding_batch(self.stack_case(), layout='ragged')
+
+
+class TestCropModes:
+    @staticmethod
+    def case():
+        im = np.zeros((8, 9), dtype=np.uint8)
+        im[2:5, 3:7] = 200
+        return im
+
+    def test_box(self):
+        assert crop_boundary_and_padding(self.case(), mode='box') == (2, 5, 3, 7)
+
+    def test_view(self):
+        im = self.case()
+        view = crop_boundary_and_padding(im, mode='view')
+        assert np.shares_memory(view, im)
+        assert view.shape == (3, 4)
+        with pytest.raises(ValueError, match='view mode of crop function can not apply padding'):
+            crop_boundary_and_padding(im, padding=1, mode='view')
+
+    def test_out(self):
+        im = self.case()
+        out = np.full((2, 12, 12), 7, dtype=np.uint8)
+        res = crop_boundary_and_padding(im, padding=[1, 2, 3, 0], out=out[1])
+        assert np.shares_memory(res, out)
+        assert np.array_equal(res, crop_boundary_and_padding(im, padding=[1, 2, 3, 0]))
+        assert out[1].sum() == res.sum()
+        assert (out[0] == 7).all()
+        with pytest.raises(ValueError, match='out buffer shape .* is smaller than padded crop shape .*'):
+            crop_boundary_and_padding(im, padding=5, out=out[0])
+
+    def test_batch_out(self):
+        ims = np.stack([self.case(), np.flip(self.case())])
+        out = np.full((2, 10, 10), 9, dtype=np.uint8)
+        res, shapes = crop_boundary_and_padding_batch(ims, padding=2, out=out)
+        assert res is out
+        expected, _ = crop_boundary_and_padding_batch(ims, padding=2)
+        assert np.array_equal(out[:, :expected.shape[1], :expected.shape[2]], expected)
+        assert not out[:, expected.shape[1]:].any()
+
+
+class TestCropRegions:
+    @staticmethod
+    def page():
+        im = np.zeros((30, 40), dtype=np.uint8)
+        im[2:5, 2:5] = 255     # word 1, char 1
+        im[2:6, 7:9] = 255     # word 1, char 2 (gap of 2 columns)
+        im[3:5, 20:25] = 200   # word 2
+        im[15:20, 4:10] = 255  # second line
+        im[28, 38] = 255       # noise
+        return im
+
+    def test_boxes(self):
+        boxes = region_boxes(self.page())
+        assert boxes.tolist() == [[2, 5, 2, 5], [2, 6, 7, 9], [3, 5, 20, 25], [15, 20, 4, 10], [28, 29, 38, 39]]
+        assert region_boxes(self.page(), min_area=2).tolist()[-1] == [15, 20, 4, 10]
+
+    def test_merge(self):
+        boxes = region_boxes(self.page(), merge_distance=(2, 0), min_area=2)
+        assert boxes.tolist() == [[2, 6, 2, 9], [3, 5, 20, 25], [15, 20, 4, 10]]
+        boxes = region_boxes(self.page(), merge_distance=(15, 0), min_area=2)
+        assert boxes.tolist() == [[2, 6, 2, 25], [15, 20, 4, 10]]
+        boxes = region_boxes(self.page(), merge_distance=(0, 20))
+        assert [2, 20, 2, 10] in boxes.tolist()
+
+    def test_crops_match_single(self):
+        im = self.page()
+        out, shapes, boxes = crop_regions_and_padding(im, padding=[1, 2, 3, 4], merge_distance=(2, 0))
+        assert len(out) == len(shapes) == len(boxes) == 4
+        for i, (row_start, row_end, col_start, col_end) in enumerate(boxes):
+            expected = crop_boundary_and_padding(im[row_start:row_end, col_start:col_end], padding=[1, 2, 3, 4])
+            assert np.array_equal(out[i, :shapes[i, 0], :shapes[i, 1]], expected)
+        buffer, offsets, packed_shapes, _ = crop_regions_and_padding(im, padding=1, layout='packed')
+        assert len(offsets) == 6 and offsets[-1] == buffer.size
+
+    def test_empty(self):
+        out, shapes, boxes = crop_regions_and_padding(np.zeros((5, 5), dtype=np.uint8))
+        assert out.shape == (0, 0, 0) and len(boxes) == 0
+
+
+class TestCropChunked:
+    @staticmethod
+    def page(height=300, width=200, seed=0):
+        rng = np.random.RandomState(seed)
+        im = rng.randint(0, 40, size=(height, width)).astype(np.uint8)
+        im[123:171, 37:150] = rng.randint(180, 256, size=(48, 113))
+        return im
+
+    @pytest.mark.parametrize('chunk_rows', [1, 7, 64, 1000])
+    def test_same_as_in_memory(self, chunk_rows):
+        im = self.page()
+        expected = crop_boundary_and_padding(im, padding=[1, 2, 3, 4])
+        res = crop_boundary_and_padding_chunked(im, padding=[1, 2, 3, 4], chunk_rows=chunk_rows)
+        assert np.array_equal(res, expected)
+        assert crop_boundary_and_padding_chunked(im, chunk_rows=chunk_rows, mode='box') == \
+            crop_boundary_and_padding(im, mode='box')
+
+    def test_npy_and_raw_files(self, tmpdir):
+        im = self.page()
+        expected = crop_boundary_and_padding(im, padding=5)
+        npy_path = str(tmpdir.join('page.npy'))
+        np.save(npy_path, im)
+        assert np.array_equal(crop_boundary_and_padding_chunked(npy_path, padding=5, chunk_rows=32), expected)
+        raw_path = str(tmpdir.join('page.raw'))
+        with open(raw_path, 'wb') as f:
+            f.write(b'header')
+            f.write(im.tobytes())
+        res = crop_boundary_and_padding_chunked(raw_path, padding=5, shape=im.shape, offset=6, chunk_rows=32)
+        assert np.array_equal(res, expected)
+        with pytest.raises(ValueError, match='shape is required for raw image files'):
+            crop_boundary_and_padding_chunked(raw_path)
+
+    def test_fixed_thresh_and_out(self):
+        im = self.page()
+        assert crop_boundary_and_padding_chunked(im, thresh=200, mode='box') == \
+            crop_boundary_and_padding(im, binarized=(im > 200).astype(np.uint8), mode='box')
+        out = np.full((60, 120), 7, dtype=np.uint8)
+        res = crop_boundary_and_padding_chunked(im, padding=1, out=out)
+        assert np.shares_memory(res, out)
+        assert np.array_equal(res, crop_boundary_and_padding(im, padding=1))
+        assert out[res.shape[0]:].sum() == 0
+
+    def test_memory_scales_with_chunk(self, tmpdir):
+        import tracemalloc
+        height, width = 4000, 1000
+        path = str(tmpdir.join('big.npy'))
+        im = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(height, width))
+        im[1000:1010, 200:300] = 255
+        im.flush()
+        del im
+        tracemalloc.start()
+        try:
+            res = crop_boundary_and_padding_chunked(path, padding=2, chunk_rows=64)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert res.shape == (14, 104)
+        # histogram and mask temporaries of one chunk, far below the 4 MB image
+        assert peak < 64 * width * 8 + height * 2 + 200000
+
+    def test_errors(self):
+        with pytest.raises(ValueError, match='In image for crop function is all zero'):
+            crop_boundary_and_padding_chunked(np.zeros((5, 5), dtype=np.uint8), thresh=0)
+        with pytest.raises(TypeError, match='input image must be gray scale image as uint8 ndarray'):
+            crop_boundary_and_padding_chunked(np.zeros((5, 5), dtype=np.float32))
+        with pytest.raises(ValueError, match='mode must be "copy" or "box"'):
+            crop_boundary_and_padding_chunked(self.page(), mode='view')
@@ -0,0 +1,65 @@
+import os
+import torch
+import torch.nn as nn
+import pytest
+from lailib.torch.delta_checkpoint import DeltaCheckpointer, load_delta_state
+from lailib.torch.parameter_store import load_network, load_last_checkpoint, save_network
+
+
+class DummyTorchModule(nn.Module):
+    def __init__(self):
+        super(DummyTorchModule, self).__init__()
+        self.frozen = nn.Linear(64, 64)
+        self.head = nn.Linear(64, 3)
+        self.frozen.requires_grad_(False)
+
+    def forward(self, x):
+        return self.head(self.frozen(x))
+
+
+def train_step(model, optimizer):
+    optimizer.zero_grad()
+    model(torch.randn(8, 64)).sum().backward()
+    optimizer.step()
+
+
+@pytest.mark.parametrize('diff', [None, 'xor'])
+def test_delta_roundtrip(tmpdir, diff):
+    model = DummyTorchModule()
+    optimizer = torch.optim.Adam(model.head.parameters(), lr=1e-3)
+    checkpointer = DeltaCheckpointer(tmpdir, 'Dummy', full_every=3, diff=diff)
+    expected = {}
+    for step in range(1, 6):
+        train_step(model, optimizer)
+        path = checkpointer.save(model, optimizer, step)
+        expected[step] = (dict((k, v.clone()) for k, v in model.state_dict().items()), path)
+    names = sorted(os.listdir(str(tmpdir)))
+    assert names == ['Dummy_1.tensors', 'Dummy_2.delta', 'Dummy_3.delta', 'Dummy_4.tensors', 'Dummy_5.delta']
+    # the frozen layer is only stored in the base files
+    assert os.path.getsize(os.path.join(tmpdir, 'Dummy_2.delta')) < os.path.getsize(os.path.join(tmpdir, 'Dummy_1.tensors')) / 2
+
+    for step, (state_dict, _) in expected.items():
+        state = load_delta_state(tmpdir, 'Dummy', step)
+        for key, value in state_dict.items():
+            assert torch.equal(state['state_dict'][key], value)
+    assert torch.equal(load_delta_state(tmpdir, 'Dummy', 5)['optimizer']['state'][0]['exp_avg'],
+                       optimizer.state_dict()['state'][0]['exp_avg'])
+
+    reload_model = DummyTorchModule()
+    reload_optimizer = torch.optim.Adam(reload_model.head.parameters(), lr=1e-3)
+    reload_model, reload_optimizer, step = load_last_checkpoint(reload_model, reload_optimizer, tmpdir, 'Dummy',
+                                                                use_gpu=False, fmt='delta')
+    assert step == 5
+    reload_model, _ = load_network(reload_model, reload_optimizer, tmpdir, 'Dummy', 3, use_gpu=False,
+                                   reset_optimizer=True, fmt='delta')
+    assert torch.equal(reload_model.head.weight, expected[3][0]['head.weight'])
+
+
+def test_invalid_args(tmpdir):
+    with pytest.raises(ValueError, match='model name can not contain "." or "_"'):
+        DeltaCheckpointer(tmpdir, 'dummy_model')
+    with pytest.raises(ValueError, match='diff must be None or "xor"'):
+        DeltaCheckpointer(tmpdir, 'Dummy', diff='sub')
+    model = DummyTorchModule()
+    with pytest.raises(ValueError, match='delta checkpoints must be saved with DeltaCheckpointer'):
+        save_network(model, torch.optim.SGD(model.head.parameters(), lr=1), tmpdir, 'Dummy', 0, fmt='delta')
@@ -0,0 +1,110 @@
+import json
+import os
+import pytest
+from lailib import io as lai_io
+from lailib.io import load_json, clear_json_cache, iter_jsonl, iter_json_array
+
+RECORDS = [{'path': 'a.png', 'label': 'hello'}, 12345, 'text', [1, 2.5, None], {'nested': {'x': [True, False]}}, -7e3]
+
+
+def test_load_json(tmpdir):
+    path = str(tmpdir.join('meta.json'))
+    with open(path, 'w') as f:
+        json.dump({'a': 1}, f)
+    assert load_json(path) == {'a': 1}
+
+
+def test_load_json_cache(tmpdir):
+    clear_json_cache()
+    path = str(tmpdir.join('meta.json'))
+    with open(path, 'w') as f:
+        json.dump({'a': 1}, f)
+    first = load_json(path, cache=True)
+    assert load_json(path, cache=True) is first
+    assert load_json(path) is not first
+    with open(path, 'w') as f:
+        json.dump({'a': 22}, f)
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+    assert load_json(path, cache=True) == {'a': 22}
+
+
+def test_iter_jsonl(tmpdir):
+    path = str(tmpdir.join('labels.jsonl'))
+    with open(path, 'w') as f:
+        for record in RECORDS:
+            f.write(json.dumps(record) + '\n\n')
+    assert list(iter_jsonl(path)) == RECORDS
+    with open(path, 'a') as f:
+        f.write('{broken\n')
+    with pytest.raises(ValueError, match='invalid json in .* line 13'):
+        list(iter_jsonl(path))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 1 << 20])
+def test_iter_json_array(tmpdir, chunk_size):
+    path = str(tmpdir.join('labels.json'))
+    with open(path, 'w') as f:
+        f.write('  \n' + json.dumps(RECORDS, indent=1))
+    assert list(iter_json_array(path, chunk_size=chunk_size)) == RECORDS
+    with open(path, 'w') as f:
+        f.write('[ ]')
+    assert list(iter_json_array(path, chunk_size=chunk_size)) == []
+
+
+@pytest.mark.parametrize('content', ['{"a": 1}', '', '[1, 2', '[1 2]', '[1, {"a": ]', '[1,]', '[1, ]', '[,]', '[,1]'])
+def test_iter_json_array_invalid(tmpdir, content):
+    path = str(tmpdir.join('labels.json'))
+    with open(path, 'w') as f:
+        f.write(content)
+    with pytest.raises(ValueError):
+        list(iter_json_array(path, chunk_size=2))
+
+
+def test_stdlib_fallback(tmpdir, monkeypatch):
+    monkeypatch.setattr(lai_io, '_fast_json', None)
+    path = str(tmpdir.join('labels.jsonl'))
+    with open(path, 'w') as f:
+        f.write('{"a": 1}\n')
+    assert list(iter_jsonl(path)) == [{'a': 1}]
+
+
+def test_fast_backend_matches_stdlib(tmpdir, monkeypatch):
+    monkeypatch.setattr(lai_io, '_fast_json', pytest.importorskip('orjson'))
+    big = 123456789012345678901234567890
+    path = str(tmpdir.join('labels.json'))
+    with open(path, 'w') as f:
+        json.dump({'a': float('nan'), 'b': float('inf'), 'big': big, 'text': '\ud800'}, f)
+    res = load_json(path)
+    assert res['a'] != res['a'] and res['b'] == float('inf')
+    assert res['big'] == big and isinstance(res['big'], int)
+    assert res['text'] == '\ud800'
+
+    path = str(tmpdir.join('labels.jsonl'))
+    with open(path, 'w') as f:
+        f.write('{"a": NaN}\n{"big": %d}\n{"c": 1}\n' % big)
+    records = list(iter_jsonl(path))
+    assert records[0]['a'] != records[0]['a']
+    assert records[1] == {'big': big}
+    assert records[2] == {'c': 1}
+
+
+def test_long_float_uses_fast_backend(tmpdir, monkeypatch):
+    orjson = pytest.importorskip('orjson')
+    calls = []
+
+    class Backend(object):
+        @staticmethod
+        def loads(s):
+            calls.append(s)
+            return orjson.loads(s)
+
+    monkeypatch.setattr(lai_io, '_fast_json', Backend)
+    path = str(tmpdir.join('labels.json'))
+    with open(path, 'w') as f:
+        f.write('{"score": 0.0030995410843868143, "e": 1.5e-1234567890123456789, "n": 12345678901234567.5}')
+    assert load_json(path)['score'] == 0.0030995410843868143
+    assert len(calls) == 1
+    with open(path, 'w') as f:
+        f.write('{"big": -1234567890123456789012}')
+    assert load_json(path) == {'big': -1234567890123456789012}
+    assert len(calls) == 1
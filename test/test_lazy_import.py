@@ -0,0 +1,43 @@
+import importlib
+import subprocess
+import sys
+
+import pytest
+
+import lailib
+
+HEAVY_MODULES = ('cv2', 'torch', 'numpy')
+
+
+def imported_heavy_modules(code):
+    '''
+    run code in a fresh interpreter
+    :return: the heavy modules it imported
+    '''
+    check = code + '\nimport sys\nprint(" ".join(m for m in %r if m in sys.modules))' % (HEAVY_MODULES,)
+    return subprocess.check_output([sys.executable, '-c', check]).decode().split()
+
+
+@pytest.mark.parametrize('code, expected', [
+    ('import lailib', []),
+    ('import lailib; lailib.load_json', []),
+    ('import lailib; lailib.profiling.get_stats()', []),
+    ('import lailib; lailib.PackedImageDataset', ['numpy']),
+    ('import lailib; lailib.crop_boundary_and_padding', ['cv2', 'numpy']),
+    ('import lailib; lailib.save_network', ['torch', 'numpy']),
+])
+def test_heavy_backends_load_on_first_use(code, expected):
+    assert sorted(imported_heavy_modules(code)) == sorted(expected)
+
+
+def test_every_public_name_resolves():
+    for attribute in lailib.__all__:
+        module = importlib.import_module(lailib._ATTRIBUTE_MODULES[attribute])
+        assert getattr(lailib, attribute) is getattr(module, attribute)
+    assert 'load_json' in dir(lailib) and 'image' in dir(lailib)
+    assert lailib.image.crop.crop_boundary_and_padding is lailib.crop_boundary_and_padding
+
+
+def test_unknown_attribute():
+    with pytest.raises(AttributeError, match="has no attribute 'does_not_exist'"):
+        lailib.does_not_exist
@@ -0,0 +1,66 @@
+import pickle
+import numpy as np
+import pytest
+from lailib.image.crop import crop_boundary_and_padding_batch
+from lailib.image.packed_dataset import PackedImageWriter, PackedImageDataset
+
+
+def make_images():
+    rng = np.random.RandomState(0)
+    return [rng.randint(1, 256, size=(h, w)).astype(np.uint8) for h, w in [(3, 4), (10, 1), (7, 20)]]
+
+
+def test_write_read(tmpdir):
+    prefix = str(tmpdir.join('train'))
+    ims = make_images()
+    with PackedImageWriter(prefix) as writer:
+        writer.extend(ims)
+        assert len(writer) == 3
+    dataset = PackedImageDataset(prefix)
+    assert len(dataset) == 3
+    assert dataset.shapes.tolist() == [[3, 4], [10, 1], [7, 20]]
+    for i in (2, 0, 1):
+        assert np.shares_memory(dataset[i], dataset._open())
+        assert np.array_equal(dataset[i], ims[i])
+    with pytest.raises(ValueError):
+        dataset[0][0, 0] = 1
+
+
+def test_append_mode_and_packed(tmpdir):
+    prefix = str(tmpdir.join('train'))
+    ims = make_images()
+    with PackedImageWriter(prefix) as writer:
+        writer.append(ims[0])
+    stack = np.zeros((2, 6, 6), dtype=np.uint8)
+    stack[0, 1:3, 2:5] = 255
+    stack[1, 4, 4] = 255
+    buffer, offsets, shapes = crop_boundary_and_padding_batch(stack, padding=1, layout='packed')
+    with PackedImageWriter(prefix, mode='a') as writer:
+        writer.append_packed(buffer, offsets, shapes)
+        writer.append(ims[2])
+    dataset = PackedImageDataset(prefix)
+    assert len(dataset) == 4
+    assert np.array_equal(dataset[0], ims[0])
+    assert np.array_equal(dataset[1], buffer[offsets[0]:offsets[1]].reshape(shapes[0]))
+    assert np.array_equal(dataset[2], buffer[offsets[1]:offsets[2]].reshape(shapes[1]))
+    assert np.array_equal(dataset[3], ims[2])
+
+
+def test_pickle_and_transform(tmpdir):
+    prefix = str(tmpdir.join('train'))
+    with PackedImageWriter(prefix) as writer:
+        writer.extend(make_images())
+    dataset = PackedImageDataset(prefix, transform=lambda im: im.shape)
+    dataset[0]
+    clone = pickle.loads(pickle.dumps(PackedImageDataset(prefix)))
+    assert clone._data is None and clone[1].shape == (10, 1)
+    assert dataset[2] == (7, 20)
+
+
+def test_wrong_input(tmpdir):
+    with PackedImageWriter(str(tmpdir.join('x'))) as writer:
+        with pytest.raises(TypeError, match='input image must be gray scale image as uint8 ndarray'):
+            writer.append(np.ones((2, 2)))
+        with pytest.raises(ValueError, match='do not describe a packed uint8 batch'):
+            writer.append_packed(np.zeros(5, dtype=np.uint8), [0, 5], [[2, 2]])
+    assert len(PackedImageDataset(str(tmpdir.join('x')))) == 0
@@ -0,0 +1,52 @@
+import cv2
+import numpy as np
+import pytest
+from lailib.image.crop import crop_boundary_and_padding
+from lailib.image.pipeline import PreprocessPipeline
+from lailib.image.resize_im import resize_height_keep_ratio
+
+
+def make_images(n):
+    ims = []
+    for i in range(n):
+        im = np.zeros((20, 30 + i), dtype=np.uint8)
+        im[5:12, 3:10 + i] = 255
+        ims.append(im)
+    return ims
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_ordered_matches_manual_chain(executor):
+    ims = make_images(10)
+    pipeline = PreprocessPipeline(padding=2, new_height=16, workers=2, executor=executor, max_pending=3)
+    results = list(pipeline.run(ims))
+    assert [res.index for res in results] == list(range(10))
+    for res, im in zip(results, ims):
+        expected = resize_height_keep_ratio(crop_boundary_and_padding(im, 2), 16)
+        assert np.array_equal(res.image, expected)
+
+
+def test_unordered_and_paths(tmpdir):
+    paths = []
+    for i, im in enumerate(make_images(6)):
+        path = str(tmpdir.join('%d.png' % i))
+        cv2.imwrite(path, im)
+        paths.append(path)
+    pipeline = PreprocessPipeline(workers=3, ordered=False)
+    results = sorted(pipeline.run(iter(paths)), key=lambda res: res.index)
+    assert [res.index for res in results] == list(range(6))
+    assert all(res.image.shape == (7, 7 + res.index) for res in results)
+
+
+def test_error_isolation(tmpdir):
+    items = make_images(3) + [np.zeros((5, 5), dtype=np.uint8), str(tmpdir.join('missing.png'))]
+    pipeline = PreprocessPipeline(workers=2)
+    assert [res.index for res in pipeline.run(items)] == [0, 1, 2]
+    assert [(res.index, res.stage) for res in pipeline.errors] == [(3, 'crop'), (4, 'decode')]
+
+    pipeline = PreprocessPipeline(workers=2, on_error='yield')
+    assert [res.image is None for res in pipeline.run(items)] == [False] * 3 + [True] * 2
+
+    pipeline = PreprocessPipeline(workers=2, on_error='raise')
+    with pytest.raises(ValueError, match='In image for crop function is all zero'):
+        list(pipeline.run(items))
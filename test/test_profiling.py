@@ -0,0 +1,112 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+from lailib import profiling
+from lailib.image.crop import crop_boundary_and_padding
+from lailib.image.resize_im import resize_height_keep_ratio
+from lailib.io import load_json
+from lailib.torch.parameter_store import save_network
+
+
+@pytest.fixture(autouse=True)
+def clean_stats():
+    profiling.reset()
+    yield
+    profiling.reset()
+
+
+def make_image():
+    im = np.zeros((40, 60), dtype=np.uint8)
+    im[10:20, 15:30] = 255
+    return im
+
+
+def test_disabled_records_nothing():
+    assert not profiling.is_enabled()
+    crop_boundary_and_padding(make_image(), 2)
+    assert profiling.get_stats() == {}
+    assert profiling.chrome_trace()['traceEvents'] == []
+
+
+def test_stats_counts_shapes_and_bytes():
+    im = make_image()
+    with profiling.profiling():
+        for _ in range(3):
+            crop_boundary_and_padding(im, 2)
+        resize_height_keep_ratio(im, 20)
+    assert not profiling.is_enabled()
+    stats = profiling.get_stats()
+    crop = stats['lailib.image.crop.crop_boundary_and_padding']
+    assert crop['count'] == 3
+    assert crop['shapes'] == {'40x60': 3}
+    assert crop['bytes'] == 3 * (10 + 4) * (15 + 4)
+    assert crop['p50_ms'] <= crop['p99_ms'] <= crop['max_ms']
+    assert crop['total_ms'] == pytest.approx(crop['mean_ms'] * 3)
+    # otsu_thresh is called inside the crop, nested calls are recorded too
+    assert stats['lailib.image.binarize.otsu_thresh']['count'] == 3
+    assert stats['lailib.image.resize_im.resize_height_keep_ratio']['bytes'] == 20 * 30
+
+
+def test_io_bytes(tmpdir):
+    path = str(tmpdir.join('a.json'))
+    with open(path, 'w') as f:
+        json.dump({'a': list(range(100))}, f)
+    network = torch.nn.Linear(3, 2)
+    with profiling.profiling():
+        load_json(path)
+        save_network(network, torch.optim.SGD(network.parameters(), lr=1), str(tmpdir), 'lin', 0, use_gpu=False)
+    stats = profiling.get_stats()
+    assert stats['lailib.io.load_json']['bytes'] == os.path.getsize(path)
+    assert stats['lailib.torch.parameter_store.save_network']['bytes'] == (3 * 2 + 2) * 4
+
+
+def test_percentile_matches_numpy():
+    samples = sorted(np.random.RandomState(0).rand(17).tolist())
+    for q in (0, 50, 90, 99, 100):
+        assert profiling._percentile(samples, q) == pytest.approx(np.percentile(samples, q))
+
+
+def test_chrome_trace(tmpdir):
+    with profiling.profiling():
+        crop_boundary_and_padding(make_image(), 2)
+    path = str(tmpdir.join('trace.json'))
+    profiling.save_chrome_trace(path)
+    with open(path) as f:
+        events = json.load(f)['traceEvents']
+    names = [event['name'] for event in events]
+    assert names == ['otsu_thresh', 'crop_boundary_and_padding']
+    crop = events[1]
+    assert crop['ph'] == 'X' and crop['cat'] == 'lailib.image.crop'
+    assert crop['args']['shape'] == [40, 60]
+    assert crop['ts'] <= events[0]['ts'] and events[0]['dur'] <= crop['dur']
+
+
+def test_custom_name_and_reset():
+    @profiling.instrument(name='custom', nbytes=lambda result, args, kwargs: 7)
+    def add(a, b):
+        return a + b
+
+    assert add(1, 2) == 3
+    with profiling.profiling():
+        add(1, 2)
+    assert profiling.get_stats()['custom']['bytes'] == 7
+    with profiling.profiling(reset_stats=True):
+        pass
+    assert profiling.get_stats() == {}
+
+
+def test_environment_variable(tmpdir):
+    trace_path = str(tmpdir.join('trace.json'))
+    env = dict(os.environ, LAILIB_PROFILE='1', LAILIB_PROFILE_TRACE=trace_path)
+    code = ('import numpy as np\n'
+            'from lailib.image.binarize import otsu_thresh\n'
+            'otsu_thresh(np.zeros((4, 4), dtype=np.uint8))\n')
+    subprocess.check_call([sys.executable, '-c', code], env=env)
+    with open(trace_path) as f:
+        assert [event['name'] for event in json.load(f)['traceEvents']] == ['otsu_thresh']
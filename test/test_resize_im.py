@@ -1,6 +1,7 @@
 import numpy as np
 import pytest
-from lailib.image.resize_im import resize_height_keep_ratio
+from lailib.image.resize_im import resize_height_keep_ratio, resize_height_keep_ratio_batch, resized_widths, \
+    WidthBucketSampler
 
 @pytest.mark.parametrize('original_height,original_width,goal_height,goal_width',
                         [(1, 1, 100, 100), (1, 1, 30, 30 ), (3, 5, 50, 83), (5, 3, 50, 30), (100, 250, 30, 75)])
@@ -9,3 +10,49 @@ def test_resize_height_keep_ratio(original_height, original_width, goal_height,
     ret_im = resize_height_keep_ratio(fake_im, goal_height)
     _, w = ret_im.shape
     assert(abs(goal_width - w) < 2)
+
+
+def test_resize_height_keep_ratio_batch():
+    ims = [np.random.randint(0, 256, size=(h, w)).astype(np.uint8) for h, w in [(10, 40), (20, 20), (5, 60)]]
+    batch, widths = resize_height_keep_ratio_batch(ims, 8, pad_value=3)
+    assert batch.shape == (3, 8, widths.max())
+    for i, im in enumerate(ims):
+        expected = resize_height_keep_ratio(im, 8)
+        assert widths[i] == expected.shape[1]
+        assert np.array_equal(batch[i, :, :widths[i]], expected)
+        assert (batch[i, :, widths[i]:] == 3).all()
+    out = np.ones((3, 8, 200), dtype=np.uint8)
+    res, _ = resize_height_keep_ratio_batch(ims, 8, out=out)
+    zero_padded, _ = resize_height_keep_ratio_batch(ims, 8)
+    assert res is out and np.array_equal(out[:, :, :batch.shape[2]], zero_padded)
+    assert not out[:, :, batch.shape[2]:].any()
+    with pytest.raises(ValueError, match='out buffer shape .* can not hold'):
+        resize_height_keep_ratio_batch(ims, 8, out=np.zeros((3, 8, 10), dtype=np.uint8))
+
+
+def test_resize_tall_narrow():
+    ims = [np.ones((100, 2), dtype=np.uint8), np.ones((10, 40), dtype=np.uint8)]
+    assert resize_height_keep_ratio(ims[0], 32).shape == (32, 1)
+    batch, widths = resize_height_keep_ratio_batch(ims, 32)
+    assert batch.shape == (2, 32, 128) and list(widths) == [1, 128]
+    assert (batch[0, :, :1] == 1).all() and not batch[0, :, 1:].any()
+    sampler = WidthBucketSampler([im.shape for im in ims], 32, max_batch_pixels=32 * 128)
+    assert np.array_equal(sampler.widths, widths)
+
+
+def test_width_bucket_sampler():
+    rng = np.random.RandomState(0)
+    shapes = np.stack([rng.randint(20, 40, size=100), rng.randint(20, 2000, size=100)], axis=1)
+    sampler = WidthBucketSampler(shapes, 32, max_batch_pixels=32 * 4000, max_batch_size=16)
+    batches = list(sampler)
+    assert len(batches) == len(sampler)
+    assert sorted(i for batch in batches for i in batch) == list(range(100))
+    widths = resized_widths(shapes, 32)
+    for batch in batches:
+        assert len(batch) <= 16
+        assert len(batch) * 32 * widths[batch].max() <= 32 * 4000
+    padded, used = sampler.padded_area()
+    rand_batches = np.array_split(rng.permutation(100), len(batches))
+    assert used <= padded < sampler.padded_area(rand_batches)[0]
+    with pytest.raises(ValueError, match='max_batch_pixels .* can not hold the widest image'):
+        WidthBucketSampler(shapes, 32, max_batch_pixels=100)
@@ -0,0 +1,75 @@
+import os
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from lailib.torch.parameter_store import save_network, load_network, load_last_checkpoint
+from lailib.torch.sharded_checkpoint import load_sharded_state, sharded_checkpoint_dir
+
+
+class DummyTorchModule(nn.Module):
+    def __init__(self):
+        super(DummyTorchModule, self).__init__()
+        self.layers = nn.Sequential(nn.Linear(8, 16), nn.Linear(16, 16), nn.Linear(16, 4))
+
+
+def make_model():
+    torch.manual_seed(0)
+    model = DummyTorchModule()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    model.layers(torch.ones(2, 8)).sum().backward()
+    optimizer.step()
+    return model, optimizer
+
+
+def _init(rank, world_size, init_file):
+    dist.init_process_group('gloo', init_method='file://' + init_file, rank=rank, world_size=world_size)
+
+
+def _save_worker(rank, world_size, init_file, save_dir):
+    _init(rank, world_size, init_file)
+    model, optimizer = make_model()
+    save_network(model, optimizer, save_dir, 'Dummy', 5, fmt='sharded')
+    dist.destroy_process_group()
+
+
+def _load_worker(rank, world_size, init_file, save_dir):
+    _init(rank, world_size, init_file)
+    expected, _ = make_model()
+    state = load_sharded_state(save_dir, 'Dummy', 5, keys=['state_dict'], broadcast=True)
+    for key, value in expected.state_dict().items():
+        assert torch.equal(state['state_dict'][key], value)
+    dist.destroy_process_group()
+
+
+def test_sharded_save_load(tmpdir):
+    save_dir = str(tmpdir.join('checkpoints'))
+    os.makedirs(save_dir)
+    mp.spawn(_save_worker, args=(2, str(tmpdir.join('init_save')), save_dir), nprocs=2)
+    checkpoint_dir = sharded_checkpoint_dir(save_dir, 'Dummy', 5)
+    assert sorted(os.listdir(checkpoint_dir)) == ['manifest.json', 'shard-00000-of-00002.tensors',
+                                                  'shard-00001-of-00002.tensors']
+
+    # load with a different world size
+    mp.spawn(_load_worker, args=(3, str(tmpdir.join('init_load')), save_dir), nprocs=3)
+
+    # and without torch.distributed
+    expected, expected_optimizer = make_model()
+    model = DummyTorchModule()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    model, optimizer, step = load_last_checkpoint(model, optimizer, save_dir, 'Dummy', use_gpu=False, fmt='sharded')
+    assert step == 5
+    for key, value in expected.state_dict().items():
+        assert torch.equal(model.state_dict()[key], value)
+    assert torch.equal(optimizer.state_dict()['state'][0]['exp_avg'],
+                       expected_optimizer.state_dict()['state'][0]['exp_avg'])
+
+
+def test_single_process(tmpdir):
+    model, optimizer = make_model()
+    save_network(model, optimizer, tmpdir, 'Dummy', 1, fmt='sharded')
+    assert os.listdir(sharded_checkpoint_dir(tmpdir, 'Dummy', 1)) != []
+    reload_model = DummyTorchModule()
+    reload_model, _ = load_network(reload_model, optimizer, tmpdir, 'Dummy', 1, use_gpu=False,
+                                   reset_optimizer=True, fmt='sharded')
+    assert torch.equal(reload_model.layers[0].weight, model.layers[0].weight)
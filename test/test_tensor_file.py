@@ -0,0 +1,120 @@
+import os
+import torch
+import torch.nn as nn
+import pytest
+from lailib.torch.parameter_store import save_network, load_network, load_last_checkpoint, checkpoint_options
+from lailib.torch.tensor_file import save_tensors, TensorFile, save_state, load_state, ALIGNMENT
+
+
+class DummyTorchModule(nn.Module):
+    def __init__(self):
+        super(DummyTorchModule, self).__init__()
+        self.encoder = nn.Linear(4, 3)
+        self.decoder = nn.Linear(3, 2)
+        self.register_buffer('steps', torch.tensor(7))
+
+
+def test_save_load_tensors(tmpdir):
+    path = str(tmpdir.join('weights.tensors'))
+    tensors = {'a': torch.randn(3, 5),
+               'b.half': torch.randn(7).half(),
+               'b.bf16': torch.randn(2, 2).bfloat16(),
+               'c': torch.arange(5),
+               'mask': torch.tensor([True, False]),
+               'scalar': torch.tensor(3.5),
+               'empty': torch.zeros(0, 4),
+               'strided': torch.randn(4, 6)[:, ::2]}
+    save_tensors(tensors, path, metadata={'epoch': 3})
+    with TensorFile(path) as f:
+        assert f.metadata == {'epoch': 3}
+        assert sorted(f.keys()) == sorted(tensors)
+        for name, tensor in tensors.items():
+            loaded = f.get(name)
+            assert loaded.dtype == tensor.dtype and torch.equal(loaded, tensor)
+        assert sorted(f.load(prefix='b.')) == ['b.bf16', 'b.half']
+        assert list(f.load(names=['c'])) == ['c']
+        assert all(entry['offset'] % ALIGNMENT == 0 for entry in f.entries.values())
+        view = f.get('a')
+        view += 1
+        assert torch.equal(f.get('a', copy=True), tensors['a'] + 1)
+    # copy on write mapping never touches the file
+    assert torch.equal(TensorFile(path).get('a'), tensors['a'])
+
+
+def test_invalid_file(tmpdir):
+    path = str(tmpdir.join('weights.pth'))
+    torch.save({'a': torch.ones(1)}, path)
+    with pytest.raises(ValueError, match='is not a tensor file'):
+        TensorFile(path)
+    with pytest.raises(TypeError, match='is not supported by the tensor file format'):
+        save_tensors({'c': torch.ones(2, dtype=torch.complex64)}, str(tmpdir.join('c.tensors')))
+
+
+def test_state_roundtrip(tmpdir):
+    model = DummyTorchModule()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3, betas=(0.8, 0.9))
+    model.encoder.weight.sum().backward()
+    optimizer.step()
+    path = str(tmpdir.join('state.tensors'))
+    save_state({'state_dict': model.state_dict(), 'optimizer': optimizer.state_dict()}, path)
+    state = load_state(path)
+    assert state['optimizer']['param_groups'] == optimizer.state_dict()['param_groups']
+    assert set(state['optimizer']['state']) == set(optimizer.state_dict()['state'])
+    for key, value in model.state_dict().items():
+        assert torch.equal(state['state_dict'][key], value)
+    assert list(load_state(path, keys=['state_dict'])) == ['state_dict']
+
+
+def test_save_load_network(tmpdir):
+    model = DummyTorchModule()
+    optimizer = torch.optim.Adagrad(model.parameters(), lr=5e-4)
+    save_network(model, optimizer, tmpdir, 'Dummy', 3, use_gpu=False, fmt='tensors')
+    save_network(model, optimizer, tmpdir, 'Dummy', 9, use_gpu=False)
+    assert os.path.exists(os.path.join(tmpdir, 'Dummy_3.tensors'))
+    reload_model = DummyTorchModule()
+    reload_optimizer = torch.optim.Adagrad(reload_model.parameters(), lr=5e-4)
+    reload_model, reload_optimizer = load_network(reload_model, reload_optimizer, tmpdir, 'Dummy', 3,
+                                                  use_gpu=False, fmt='tensors')
+    for key, value in model.state_dict().items():
+        assert torch.equal(reload_model.state_dict()[key], value)
+    _, _, global_step = load_last_checkpoint(reload_model, reload_optimizer, tmpdir, 'Dummy',
+                                             use_gpu=False, reset_optimizer=True, fmt='tensors')
+    assert global_step == 3
+    with pytest.raises(ValueError, match='checkpoint format must be one of'):
+        save_network(model, optimizer, tmpdir, 'Dummy', 3, use_gpu=False, fmt='npz')
+
+
+@pytest.mark.parametrize('storage_dtype', [None, torch.float16, torch.bfloat16])
+@pytest.mark.parametrize('codec', [None, 'zlib', 'bz2', 'lzma'])
+def test_storage_options(tmpdir, storage_dtype, codec):
+    path = str(tmpdir.join('weights.tensors'))
+    tensors = {'weight': torch.randn(30, 40), 'steps': torch.arange(6), 'zeros': torch.zeros(1000),
+               'double': torch.randn(3, dtype=torch.float64)}
+    save_tensors(tensors, path, storage_dtype=storage_dtype, codec=codec, workers=2)
+    f = TensorFile(path)
+    assert f.options['codec'] == codec
+    assert f.options['storage_dtype'] == (None if storage_dtype is None else str(storage_dtype).split('.')[1])
+    for name, tensor in tensors.items():
+        loaded = f.get(name)
+        assert loaded.dtype == tensor.dtype and loaded.shape == tensor.shape
+        if storage_dtype is None or not tensor.is_floating_point():
+            assert torch.equal(loaded, tensor)
+        else:
+            assert torch.allclose(loaded, tensor, rtol=1e-2, atol=1e-2)
+    if codec is not None:
+        assert f.entries['zeros']['stored_nbytes'] < 200
+
+
+def test_save_network_storage_options(tmpdir):
+    model = DummyTorchModule()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    save_network(model, optimizer, tmpdir, 'Dummy', 1, use_gpu=False, fmt='tensors',
+                 storage_dtype=torch.float16, codec='zlib')
+    assert checkpoint_options(tmpdir, 'Dummy', 1) == {'format': 'tensors', 'storage_dtype': 'float16',
+                                                       'downcast_prefix': 'state_dict.', 'codec': 'zlib'}
+    reload_model = DummyTorchModule()
+    reload_model, _ = load_network(reload_model, optimizer, tmpdir, 'Dummy', 1, use_gpu=False, fmt='tensors')
+    assert reload_model.encoder.weight.dtype == torch.float32
+    assert torch.allclose(reload_model.encoder.weight, model.encoder.weight, atol=1e-3)
+    with pytest.raises(ValueError, match='storage_dtype and codec are only supported by the "tensors" format'):
+        save_network(model, optimizer, tmpdir, 'Dummy', 1, use_gpu=False, codec='zlib')
@@ -1,8 +1,10 @@
+import os
 import torch
 import torch.nn as nn
 from torch.nn import init
 from os import listdir
-from lailib.torch.parameter_store import save_network, load_last_checkpoint, load_network
+from lailib.torch.parameter_store import save_network, load_last_checkpoint, load_network, AsyncCheckpointSaver, \
+    average_checkpoints, checkpoint_steps
 import pytest
 
 
@@ -172,3 +174,119 @@ class TestSaveLoad():
                          use_gpu = False,
                          reset_optimizer=False)
 
+
+
+class TestAsyncSave():
+    def test_async_save_load(self, tmpdir, model_and_meta):
+        model_name, global_step, saved_model = model_and_meta
+        saved_optimizer = torch.optim.Adam(saved_model.parameters(), lr=5e-4)
+        saved_model.test_weight.sum().backward()
+        saved_optimizer.step()
+        saver = AsyncCheckpointSaver(max_in_flight=2)
+        handle = saver.save(saved_model, saved_optimizer, tmpdir, model_name, global_step)
+        assert handle.result() == os.path.join(tmpdir, '%s_%s.pth' % (model_name, global_step))
+        saver.close()
+        assert listdir(tmpdir) == ['%s_%s.pth' % (model_name, global_step)]
+
+        reload_model = DummyTorchModule()
+        reload_optimizer = torch.optim.Adam(reload_model.parameters(), lr=5e-4)
+        reload_model, reload_optimizer = load_network(reload_model, reload_optimizer, tmpdir, model_name,
+                                                      global_step, use_gpu=False)
+        assert TestSaveLoad.compare_models(saved_model, reload_model)
+        assert torch.equal(reload_optimizer.state_dict()['state'][0]['exp_avg'],
+                           saved_optimizer.state_dict()['state'][0]['exp_avg'])
+
+    def test_snapshot_is_isolated_and_buffers_reused(self, tmpdir, model_and_meta):
+        model_name, _, saved_model = model_and_meta
+        optimizer = torch.optim.Adagrad(saved_model.parameters(), lr=5e-4)
+        saver = AsyncCheckpointSaver(max_in_flight=1)
+        expected = saved_model.test_weight.detach().clone()
+        saver.save(saved_model, optimizer, tmpdir, model_name, 1)
+        with torch.no_grad():
+            saved_model.test_weight.add_(1)
+        saver.save(saved_model, optimizer, tmpdir, model_name, 2)
+        saver.wait()
+        assert len(saver._free_buffers) == 1
+        saver.save(saved_model, optimizer, tmpdir, model_name, 3)
+        saver.close()
+        assert len(saver._free_buffers) == 1
+        assert torch.equal(torch.load(os.path.join(tmpdir, 'Dummy_1.pth'))['state_dict']['test_weight'], expected)
+        assert torch.equal(torch.load(os.path.join(tmpdir, 'Dummy_3.pth'))['state_dict']['test_weight'], expected + 1)
+        _, _, global_step = load_last_checkpoint(DummyTorchModule(), optimizer, tmpdir, model_name, use_gpu=False)
+        assert global_step == 3
+
+    def test_invalid_args(self, tmpdir, model_and_meta):
+        _, _, saved_model = model_and_meta
+        with pytest.raises(ValueError, match='max_in_flight must be at least 1'):
+            AsyncCheckpointSaver(max_in_flight=0)
+        with pytest.raises(ValueError, match='model name can not contain "." or "_"'):
+            AsyncCheckpointSaver().save(saved_model, torch.optim.SGD(saved_model.parameters(), lr=1), tmpdir,
+                                        'dummy_model', 0)
+
+
+class BatchNormModule(nn.Module):
+    def __init__(self):
+        super(BatchNormModule, self).__init__()
+        self.linear = nn.Linear(4, 3)
+        self.norm = nn.BatchNorm1d(3)
+
+
+class TestAverageCheckpoints():
+    @staticmethod
+    def save_steps(tmpdir, steps, fmt):
+        model = BatchNormModule()
+        optimizer = torch.optim.SGD(model.parameters(), lr=1)
+        weights = []
+        for step in steps:
+            with torch.no_grad():
+                model.linear.weight.normal_()
+            model.norm.num_batches_tracked.fill_(step)
+            weights.append(model.linear.weight.detach().clone())
+            save_network(model, optimizer, tmpdir, 'avg', step, use_gpu=False, fmt=fmt)
+        return weights
+
+    @pytest.mark.parametrize('fmt', ['pth', 'tensors'])
+    def test_uniform(self, tmpdir, fmt):
+        weights = self.save_steps(tmpdir, [10, 20, 30], fmt)
+        assert checkpoint_steps(tmpdir, 'avg', fmt) == [10, 20, 30]
+        path = average_checkpoints(tmpdir, 'avg', [10, 20, 30], 31, fmt=fmt, workers=2)
+        assert os.path.basename(path) == 'avg_31.' + fmt
+
+        model = BatchNormModule()
+        model, _, global_step = load_last_checkpoint(model, torch.optim.SGD(model.parameters(), lr=1),
+                                                     tmpdir, 'avg', use_gpu=False, fmt=fmt)
+        assert global_step == 31
+        assert torch.allclose(model.linear.weight, torch.stack(weights).mean(0), atol=1e-6)
+        assert model.norm.num_batches_tracked.item() == 30
+        assert model.norm.num_batches_tracked.dtype == torch.long
+
+    def test_ema_and_output_fmt(self, tmpdir):
+        weights = self.save_steps(tmpdir, [1, 2, 3], 'pth')
+        path = average_checkpoints(tmpdir, 'avg', [1, 2, 3], 4, mode='ema', decay=0.5, output_fmt='tensors')
+        assert path.endswith('avg_4.tensors')
+        model = BatchNormModule()
+        model, _ = load_network(model, None, tmpdir, 'avg', 4, use_gpu=False, reset_optimizer=True, fmt='tensors')
+        expected = (weights[0] * 0.5 + weights[1] * 0.5) * 0.5 + weights[2] * 0.5
+        assert torch.allclose(model.linear.weight, expected, atol=1e-6)
+
+    def test_half_precision_is_accumulated_in_float32(self, tmpdir):
+        model = nn.Linear(1, 1, bias=False).half()
+        optimizer = torch.optim.SGD(model.parameters(), lr=1)
+        for step, value in enumerate([2048, 2049, 2050]):
+            model.weight.data.fill_(value)
+            save_network(model, optimizer, tmpdir, 'half', step, use_gpu=False, fmt='tensors')
+        average_checkpoints(tmpdir, 'half', [0, 1, 2], 3, fmt='tensors')
+        model, _ = load_network(model, optimizer, tmpdir, 'half', 3, use_gpu=False, fmt='tensors')
+        assert model.weight.dtype == torch.float16
+        assert model.weight.item() == 2048
+
+    def test_invalid_args(self, tmpdir):
+        self.save_steps(tmpdir, [1], 'pth')
+        with pytest.raises(ValueError, match='mode must be'):
+            average_checkpoints(tmpdir, 'avg', [1], 2, mode='median')
+        with pytest.raises(ValueError, match='decay must be'):
+            average_checkpoints(tmpdir, 'avg', [1], 2, mode='ema', decay=1)
+        with pytest.raises(ValueError, match='global_steps is empty'):
+            average_checkpoints(tmpdir, 'avg', [], 2)
+        with pytest.raises(ValueError, match='output_fmt must be'):
+            average_checkpoints(tmpdir, 'avg', [1], 2, output_fmt='delta')